@@ -0,0 +1,78 @@
+# Request latency with a new aiohttp session per request (how TwitchApi and Auth used to call helix) against the
+# shared keep-alive HttpSession.
+#
+# A local stand-in for helix answers every GET with a small users payload over plain http, so this only shows the
+# connection setup we save. Against the real api the gap is bigger, every new connection there also pays for tls.
+#
+#   PYTHONPATH=. python benchmarks/http_pool.py [--requests 300] [--concurrency 1]
+import argparse
+import asyncio
+import statistics
+import time
+import aiohttp
+from aiohttp import web
+from stashio.utils.http import HttpSession
+
+HOST = '127.0.0.1'
+PORT = 8770
+PAYLOAD = {"data": [{"id": "123456789", "login": "somechannel", "display_name": "SomeChannel", "type": "", "broadcaster_type": "partner"}]}
+HEADERS = {"Client-Id": "bench", "Authorization": "Bearer bench"}
+
+async def helix_handler(request):
+    return web.json_response(PAYLOAD, headers={"Ratelimit-Limit": "800", "Ratelimit-Remaining": "799"})
+
+async def request_new_session(in_http, in_url):
+    async with aiohttp.ClientSession(headers=HEADERS) as session:
+        async with session.get(in_url) as response:
+            return await response.json()
+
+async def request_shared_session(in_http, in_url):
+    session = await in_http.get()
+    async with session.get(in_url, headers=HEADERS) as response:
+        return await response.json()
+
+async def measure(in_request, in_http, in_count, in_concurrency):
+    url = f"http://{HOST}:{PORT}/helix/users?login=somechannel"
+    latencies = []
+    semaphore = asyncio.Semaphore(in_concurrency)
+
+    async def one():
+        async with semaphore:
+            start = time.perf_counter()
+            await in_request(in_http, url)
+            latencies.append(time.perf_counter() - start)
+
+    # warm up the dns cache and the pool so both sides start from the same place
+    await in_request(in_http, url)
+    start = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(in_count)])
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "p50": statistics.median(latencies) * 1000,
+        "p99": latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)] * 1000,
+        "rps": in_count / elapsed
+    }
+
+async def main(in_args):
+    app = web.Application()
+    app.router.add_get('/helix/users', helix_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, HOST, PORT).start()
+
+    http = HttpSession()
+    try:
+        for name, request in (("session per request", request_new_session), ("shared HttpSession", request_shared_session)):
+            result = await measure(request, http, in_args.requests, in_args.concurrency)
+            print(f"{name:>20}: p50 {result['p50']:.2f} ms  p99 {result['p99']:.2f} ms  {result['rps']:,.0f} req/s")
+    finally:
+        await http.close()
+        await runner.cleanup()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--concurrency', type=int, default=1)
+    asyncio.run(main(parser.parse_args()))
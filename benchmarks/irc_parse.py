@@ -0,0 +1,86 @@
+# IRCData parsing speed and memory on twitch style chat lines.
+#
+# "dispatch" only reads what the receive path needs to route a line (command and channel), "handler" also reads what
+# a PRIVMSG handler touches (content, user id, display name, badges). Memory is what each parsed IRCData keeps alive,
+# measured with tracemalloc over a list of them.
+#
+#   PYTHONPATH=. python benchmarks/irc_parse.py
+#
+# Only IRCData's public properties are used, so the numbers can be compared against an older checkout:
+#
+#   PYTHONPATH=/path/to/old/checkout python benchmarks/irc_parse.py
+import argparse
+import time
+import tracemalloc
+from stashio.irc.types import IRCData
+
+LINES = [
+    "@badge-info=subscriber/14;badges=subscriber/12,premium/1;client-nonce=4c2b0ed7a2f8e1e5d0b1;color=#1E90FF;"
+    "display-name=SomeChatter;emotes=25:0-4,12-16;first-msg=0;flags=;id=8d7c0e6a-1b2c-4d5e-9f00-112233445566;mod=0;"
+    "returning-chatter=0;room-id=123456789;subscriber=1;tmi-sent-ts=1700000000000;turbo=0;user-id=987654321;user-type= "
+    ":somechatter!somechatter@somechatter.tmi.twitch.tv PRIVMSG #somechannel :Kappa hello Kappa how is everyone",
+    "@badge-info=;badges=moderator/1;color=;display-name=ModPerson;emotes=;first-msg=0;flags=;"
+    "id=0a1b2c3d-0000-4000-8000-000000000001;mod=1;returning-chatter=0;room-id=123456789;subscriber=0;"
+    "tmi-sent-ts=1700000000001;turbo=0;user-id=11111111;user-type=mod "
+    ":modperson!modperson@modperson.tmi.twitch.tv PRIVMSG #somechannel :\x01ACTION waves at chat\x01",
+    "@badge-info=;badges=broadcaster/1;color=#FF0000;display-name=SomeChannel;emotes=;first-msg=0;flags=;"
+    "id=0a1b2c3d-0000-4000-8000-000000000002;mod=0;returning-chatter=0;room-id=123456789;subscriber=0;"
+    "tmi-sent-ts=1700000000002;turbo=0;user-id=123456789;user-type= "
+    ":somechannel!somechannel@somechannel.tmi.twitch.tv PRIVMSG #somechannel :!uptime",
+    "@emote-only=0;followers-only=-1;r9k=0;room-id=123456789;slow=0;subs-only=0 :tmi.twitch.tv ROOMSTATE #somechannel",
+    "@msg-id=msg_ratelimit :tmi.twitch.tv NOTICE #somechannel :Your message was not sent because you are sending messages too quickly.",
+    "PING :tmi.twitch.tv",
+]
+
+# roughly how often each kind of line shows up in a busy channel
+WEIGHTS = [80, 5, 5, 1, 1, 1]
+
+def build_sample(in_count):
+    sample = []
+    weighted = [line for line, weight in zip(LINES, WEIGHTS) for _ in range(weight)]
+    while len(sample) < in_count:
+        sample += weighted
+    return sample[:in_count]
+
+def read_dispatch(in_data):
+    return in_data.command, in_data.channel
+
+def read_handler(in_data):
+    if in_data.command == "PRIVMSG":
+        return in_data.channel, in_data.content, in_data.user_id, in_data.display_name, in_data.badges
+    return in_data.command, in_data.channel
+
+def measure_rate(in_sample, in_reader, in_rounds):
+    best = None
+    for _ in range(in_rounds):
+        start = time.perf_counter()
+        for line in in_sample:
+            in_reader(IRCData(line))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(in_sample) / best
+
+def measure_memory(in_line, in_reader, in_count):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = []
+    for _ in range(in_count):
+        data = IRCData(in_line)
+        in_reader(data)
+        kept.append(data)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # the list itself isn't part of the message
+    return (after - before - kept.__sizeof__()) / in_count
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=100000)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    sample = build_sample(args.lines)
+    for name, reader in (("dispatch", read_dispatch), ("handler", read_handler)):
+        rate = measure_rate(sample, reader, args.rounds)
+        memory = measure_memory(LINES[0], reader, 20000)
+        print(f"{name:>8}: {rate:>10,.0f} lines/s  {memory:>7,.0f} bytes per PRIVMSG")
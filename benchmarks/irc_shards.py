@@ -0,0 +1,145 @@
+# Aggregate chat throughput of IRCShardManager with 1, 2, 4 and 8 shards.
+#
+# A fake IRC server runs in its own process so it doesn't compete with the bot for the loop. Every connection it
+# accepts gets a 001 after NICK and then PRIVMSGs as fast as the bot reads them, so the number reported is how many
+# chat lines the bot side gets through its receive path (parse, dispatch, user manager, event_irc_message) per second.
+# Every shard runs on the same event loop, so past the first shard the gain is in what twitch allows per connection
+# (channels, joins, lines), not in cpu. Run it on a machine with a spare core so the server isn't stealing time.
+#
+#   PYTHONPATH=. python benchmarks/irc_shards.py [--duration 5] [--shards 1 2 4 8]
+import argparse
+import asyncio
+import itertools
+import multiprocessing
+import time
+from aiohttp import web
+from stashio.irc.shard_manager import IRCShardManager
+
+HOST = '127.0.0.1'
+PORT = 8769
+# lines per websocket frame the server sends, twitch also packs several lines into one frame under load
+LINES_PER_FRAME = 50
+# distinct chatters and channels each connection sends lines for
+USERS = 5000
+CHANNELS_PER_CONNECTION = 50
+
+PRIVMSG = ("@badge-info=;badges=subscriber/12;color=#1E90FF;display-name=user{user};emotes=;first-msg=0;flags=;"
+           "id=8d7c0e6a-{user:08d};mod=0;room-id={room};subscriber=1;tmi-sent-ts=1700000000000;turbo=0;user-id={user};"
+           "user-type= :user{user}!user{user}@user{user}.tmi.twitch.tv PRIVMSG #chan{room} :hello chat this is message {i}")
+
+def build_frames(in_connection):
+    frames = []
+    i = 0
+    for _ in range(200):
+        lines = []
+        for _ in range(LINES_PER_FRAME):
+            room = in_connection * CHANNELS_PER_CONNECTION + i % CHANNELS_PER_CONNECTION + 1
+            lines.append(PRIVMSG.format(user=i % USERS + 1, room=room, i=i))
+            i += 1
+        frames.append("\r\n".join(lines) + "\r\n")
+    return frames
+
+async def irc_handler(request):
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
+    frames = build_frames(next(request.app["connections"]))
+
+    async def stream():
+        i = 0
+        while not ws.closed:
+            await ws.send_str(frames[i % len(frames)])
+            i += 1
+
+    streamer = None
+    async for msg in ws:
+        if msg.type != web.WSMsgType.TEXT:
+            break
+        for line in msg.data.split("\r\n"):
+            if line.startswith("NICK ") and streamer is None:
+                await ws.send_str(":tmi.twitch.tv 001 benchbot :Welcome, GLHF!\r\n")
+                streamer = asyncio.get_event_loop().create_task(stream())
+    if streamer:
+        streamer.cancel()
+    return ws
+
+def run_server():
+    app = web.Application()
+    app["connections"] = itertools.count()
+    app.router.add_get('/', irc_handler)
+    web.run_app(app, host=HOST, port=PORT, print=None)
+
+class BenchAuth():
+    def get_user(self):
+        return "benchbot"
+
+    async def get_valid_irc_token(self):
+        return "oauth:bench"
+
+class BenchBot():
+    def __init__(self):
+        self.messages = 0
+        self.has_irc_message_handler = True
+
+    def match_command(self, in_content, in_channel):
+        return None
+
+    async def event_irc_message(self, message):
+        self.messages += 1
+
+    async def event_irc_connected(self):
+        pass
+
+    async def event_irc_roomstate(self, updated_channel):
+        pass
+
+    async def event_irc_userstate(self, updated_channel):
+        pass
+
+    async def event_irc_notice(self, channel, notice):
+        pass
+
+async def measure(in_shards, in_duration, in_warmup):
+    bot = BenchBot()
+    manager = IRCShardManager(bot, BenchAuth(), None, in_channels_per_shard=1, in_max_shards=in_shards, in_server=f'ws://{HOST}:{PORT}/')
+    # one channel per shard is enough to get every shard opened, the server doesn't wait for joins
+    await manager.join_channels([f"benchchannel{i}" for i in range(in_shards)])
+    runner = asyncio.get_event_loop().create_task(manager.run())
+
+    await asyncio.sleep(in_warmup)
+    start_count = bot.messages
+    start = time.perf_counter()
+    await asyncio.sleep(in_duration)
+    rate = (bot.messages - start_count) / (time.perf_counter() - start)
+
+    await manager.stop(1)
+    await asyncio.gather(runner, return_exceptions=True)
+    return rate
+
+async def main(in_args):
+    results = []
+    for shards in in_args.shards:
+        rate = await measure(shards, in_args.duration, in_args.warmup)
+        results.append((shards, rate))
+        print(f"{shards} shard(s): {rate:,.0f} messages/s")
+
+    base = results[0][1]
+    print()
+    print("shards  messages/s  vs first")
+    for shards, rate in results:
+        print(f"{shards:>6}  {rate:>10,.0f}  {rate / base:>7.2f}x")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--warmup', type=float, default=2)
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    server = multiprocessing.Process(target=run_server, daemon=True)
+    server.start()
+    # give the server a moment to bind
+    time.sleep(1)
+    try:
+        asyncio.run(main(args))
+    finally:
+        server.terminate()
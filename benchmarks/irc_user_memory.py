@@ -0,0 +1,63 @@
+# Memory UserManager keeps per chatter, measured with tracemalloc.
+#
+# Feeds one PRIVMSG per chatter per channel through set_user_data, dropping each parsed line right away so only what
+# the manager holds on to is counted. Chatters are spread over the channels, and a share of them also talk in a
+# second channel, which is where per channel role storage shows up.
+#
+#   PYTHONPATH=. python benchmarks/irc_user_memory.py [--chatters 100000] [--channels 300] [--second-channel 0.2]
+#
+# Only set_user_data is used, so the numbers can be compared against an older checkout:
+#
+#   PYTHONPATH=/path/to/old/checkout python benchmarks/irc_user_memory.py
+import argparse
+import asyncio
+import gc
+import random
+import tracemalloc
+from stashio.irc.types import IRCData
+from stashio.irc.user_manager import UserManager
+
+PRIVMSG = ("@badge-info=;badges={badges};color=#1E90FF;display-name={display_name};emotes=;first-msg=0;flags=;"
+           "id=8d7c0e6a-0000-4000-8000-{user:012d};mod={mod};room-id={room};subscriber={subscriber};tmi-sent-ts=1700000000000;"
+           "turbo=0;user-id={user};user-type= :chatter{user}!chatter{user}@chatter{user}.tmi.twitch.tv PRIVMSG #channel{room} :hi")
+
+def build_lines(in_chatters, in_channels, in_second_channel, in_seed):
+    rng = random.Random(in_seed)
+    lines = []
+    for user in range(1, in_chatters + 1):
+        rooms = [rng.randint(1, in_channels)]
+        if rng.random() < in_second_channel:
+            rooms.append(rooms[0] % in_channels + 1)
+        for room in rooms:
+            roll = rng.random()
+            mod = 1 if roll < 0.01 else 0
+            subscriber = 1 if roll < 0.3 else 0
+            badges = "moderator/1" if mod else ("subscriber/12" if subscriber else "")
+            # most display names are just the login with different capitalization
+            display_name = f"chatter{user}" if rng.random() < 0.7 else f"Chatter{user}"
+            lines.append(PRIVMSG.format(badges=badges, display_name=display_name, user=user, mod=mod, room=room, subscriber=subscriber))
+    return lines
+
+async def measure(in_lines, in_chatters):
+    manager = UserManager()
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for line in in_lines:
+        await manager.set_user_data(IRCData(line))
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / in_chatters
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chatters', type=int, default=100000)
+    parser.add_argument('--channels', type=int, default=300)
+    parser.add_argument('--second-channel', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    lines = build_lines(args.chatters, args.channels, args.second_channel, args.seed)
+    per_chatter = asyncio.run(measure(lines, args.chatters))
+    print(f"{args.chatters:,} chatters over {args.channels} channels ({args.second_channel:.0%} in two): {per_chatter:,.0f} bytes per chatter")
@@ -0,0 +1,120 @@
+# Receive path throughput and idle cpu of BaseConnection.
+#
+# A local websocket server in its own process sends a burst of IRC style lines packed several to a frame, then goes
+# quiet while keeping the socket open. The bot side reports how many lines/s reached on_receive during the burst and
+# how much cpu the process burned per second of wall time while the socket sat idle. If the tree has a LineBuffer,
+# the framer alone is measured too.
+#
+#   PYTHONPATH=. python benchmarks/recv_pipeline.py [--lines 200000] [--idle 5]
+#
+# Only BaseConnection's constructor, run(), stop() and on_receive are used, so the numbers can be compared against an
+# older checkout:
+#
+#   PYTHONPATH=/path/to/old/checkout python benchmarks/recv_pipeline.py
+import argparse
+import asyncio
+import multiprocessing
+import time
+from aiohttp import web
+from stashio.connection.wss_connection import BaseConnection
+
+HOST = '127.0.0.1'
+PORT = 8771
+LINES_PER_FRAME = 50
+LINE = ("@badge-info=;badges=subscriber/12;color=#1E90FF;display-name=someone;emotes=;id=8d7c0e6a;mod=0;room-id=1;"
+        "subscriber=1;tmi-sent-ts=1700000000000;turbo=0;user-id=2;user-type= :someone!someone@someone.tmi.twitch.tv "
+        "PRIVMSG #somechannel :hello chat")
+
+def build_frames(in_lines):
+    frame = "\r\n".join([LINE] * LINES_PER_FRAME) + "\r\n"
+    return [frame] * (in_lines // LINES_PER_FRAME)
+
+async def burst_handler(request):
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
+    for frame in build_frames(request.app["lines"]):
+        await ws.send_str(frame)
+    # stay connected and silent so the client can be measured idle
+    async for _ in ws:
+        pass
+    return ws
+
+def run_server(in_lines):
+    app = web.Application()
+    app["lines"] = in_lines
+    app.router.add_get('/', burst_handler)
+    web.run_app(app, host=HOST, port=PORT, print=None)
+
+class CountingConnection(BaseConnection):
+    def __init__(self, in_server, in_expected):
+        super().__init__(in_server)
+        self.expected = in_expected
+        self.count = 0
+        self.first_at = None
+        self.last_at = None
+        self.done = asyncio.Event()
+
+    async def on_receive(self, data):
+        if self.first_at is None:
+            self.first_at = time.perf_counter()
+        self.count += 1
+        if self.count == self.expected:
+            self.last_at = time.perf_counter()
+            self.done.set()
+
+async def measure_connection(in_lines, in_idle):
+    expected = in_lines // LINES_PER_FRAME * LINES_PER_FRAME
+    connection = CountingConnection(f'ws://{HOST}:{PORT}/', expected)
+    runner = asyncio.get_event_loop().create_task(connection.run())
+
+    await asyncio.wait_for(connection.done.wait(), 120)
+    rate = expected / (connection.last_at - connection.first_at)
+
+    # the socket is open and nothing is coming in, anything we burn here is polling
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    await asyncio.sleep(in_idle)
+    idle_cpu = (time.process_time() - cpu_start) / (time.perf_counter() - wall_start)
+
+    await connection.stop()
+    runner.cancel()
+    await asyncio.gather(runner, return_exceptions=True)
+    return rate, idle_cpu
+
+def measure_line_buffer(in_lines):
+    try:
+        from stashio.utils.data import LineBuffer
+    except ImportError:
+        return None
+
+    buffer = LineBuffer('\r\n')
+    # split frames mid line so the partial line handling is part of the cost
+    data = "".join(build_frames(in_lines))
+    chunk = len(data) // (in_lines // LINES_PER_FRAME) + 7
+    frames = [data[i:i + chunk] for i in range(0, len(data), chunk)]
+    start = time.perf_counter()
+    count = 0
+    for frame in frames:
+        count += len(buffer.feed(frame))
+    return count / (time.perf_counter() - start)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=200000)
+    parser.add_argument('--idle', type=float, default=5)
+    args = parser.parse_args()
+
+    server = multiprocessing.Process(target=run_server, args=(args.lines,), daemon=True)
+    server.start()
+    # give the server a moment to bind
+    time.sleep(1)
+    try:
+        rate, idle_cpu = asyncio.run(measure_connection(args.lines, args.idle))
+    finally:
+        server.terminate()
+
+    print(f"on_receive: {rate:,.0f} lines/s")
+    print(f"idle cpu:   {idle_cpu:.1%} of a core")
+    framer = measure_line_buffer(args.lines)
+    if framer is not None:
+        print(f"LineBuffer: {framer:,.0f} lines/s")
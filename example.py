@@ -5,6 +5,9 @@ class TestBot(StashioTwitchBot):
     def __init__(self):
         super().__init__('auth.json', in_use_irc=False)
         
+        # Chat commands get routed straight to their callback. See command_hi below.
+        #self.add_command("!hi", self.command_hi)
+        
             
     # Async hook to run startup stuff for your bot (e.g. eventsub)
     async def event_initialize(self):
@@ -36,6 +39,11 @@ class TestBot(StashioTwitchBot):
     #    if message.content == "!hi":
     #        await message.reply("Hello!")
         
+    # Called when someone types !hi in a channel that the bot is in. Requires add_command in __init__.
+    # args holds the rest of the message split on whitespace.
+    #async def command_hi(self, message, args):
+    #    await message.reply("Hello!")
+        
 async def main():
     bot = TestBot()
     await bot.run()
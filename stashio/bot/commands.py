@@ -0,0 +1,54 @@
+class CommandRouter():
+    def __init__(self, in_case_sensitive=False):
+        # command name -> {channel name (None for every channel) -> callback}
+        self.__commands = dict()
+        # first characters of every registered command, lets most chat get thrown out with one lookup
+        self.__prefix_chars = set()
+        self.__case_sensitive = in_case_sensitive
+
+    def __len__(self):
+        return len(self.__commands)
+
+    def __normalize(self, in_name):
+        return in_name if self.__case_sensitive else in_name.lower()
+
+    def add(self, in_name, in_callback, in_channels=None):
+        name = self.__normalize(in_name)
+        if not name or ' ' in name:
+            raise ValueError(f"Invalid command name '{in_name}'")
+
+        channels = self.__commands.setdefault(name, dict())
+        for channel in (in_channels if in_channels else [None]):
+            channels[channel] = in_callback
+        self.__prefix_chars.add(name[0])
+
+    def remove(self, in_name, in_channels=None):
+        name = self.__normalize(in_name)
+        channels = self.__commands.get(name)
+        if channels is None:
+            return
+
+        for channel in (in_channels if in_channels else [None]):
+            channels.pop(channel, None)
+
+        if len(channels) == 0:
+            del self.__commands[name]
+            self.__prefix_chars = set(n[0] for n in self.__commands)
+
+    # Returns (callback, args) for the command at the start of the message, or None
+    def match(self, in_content, in_channel):
+        if not in_content or not in_content[0] in self.__prefix_chars:
+            return None
+
+        token, _, rest = in_content.partition(' ')
+        channels = self.__commands.get(self.__normalize(token))
+        if channels is None:
+            return None
+
+        callback = channels.get(in_channel)
+        if callback is None:
+            callback = channels.get(None)
+            if callback is None:
+                return None
+
+        return callback, rest.split()
@@ -1,11 +1,15 @@
 import asyncio
 import traceback
-from stashio.irc.irc import IRC
+from stashio.irc.shard_manager import IRCShardManager
+from stashio.bot.commands import CommandRouter
 from stashio.utils.auth import Auth
+from stashio.utils.http import HttpSession
+from stashio.utils.supervisor import Supervisor
+from stashio.utils.archive import ChatArchive
 from stashio.utils.data import DelayQueue, TimedCountQueue, TimedCountDataQueue
 from stashio.twitch.api import TwitchApi
 from stashio.twitch.users import UserBank
-from stashio.twitch.eventsub.eventsub import EventSubConnection
+from stashio.twitch.eventsub.pool import EventSubPool
 import stashio.twitch.eventsub.types as EventSubTypes
 
 class EventSubSubscriptions():
@@ -13,21 +17,39 @@ class EventSubSubscriptions():
     ChannelChatMessage = EventSubTypes.EventSub_ChannelChatMessage
 
 class StashioTwitchBot():
-    def __init__(self, in_auth, in_use_irc=False):
+    def __init__(self, in_auth, in_use_irc=False, in_irc_dispatch_workers=8, in_irc_dispatch_queue_depth=256, in_irc_channels_per_shard=None, in_irc_max_shards=None,
+                 in_http_connection_limit=100, in_http_connections_per_host=30, in_stop_deadline=10,
+                 in_irc_max_users=500000, in_irc_user_idle_ttl=6*60*60, in_irc_max_channels=10000, in_archive_directory=None, in_archive_compression=None):
+        # one pool of keep-alive connections for every helix and id.twitch.tv request
+        self.__http = HttpSession(in_limit=in_http_connection_limit, in_limit_per_host=in_http_connections_per_host)
         # auth data
-        self.__auth = Auth(in_auth)
+        self.__auth = Auth(in_auth, in_http=self.__http)
         # flag that will let our fibers stop
         self.__manual_shutdown_requested = False
+        # runs the eventsub and irc connections, restarting them with backoff if they crash
+        self.__supervisor = Supervisor()
+        # how long stop() gives the connections to shut down before cancelling them
+        self.__stop_deadline = in_stop_deadline
         # asyncio event loop
         self.__loop = asyncio.get_event_loop()
         # object for interacting with the Twitch API
         self.__api = TwitchApi(self.__auth)
         # conversion between twitch username <==> channel id
         self.__user_bank = UserBank(self.__api)
-        # object that is managing the eventsub connection
-        self.__eventsub = EventSubConnection(in_twitch_api=self.__api)
-        # object that is managing the irc connection
-        self.__irc = IRC(in_bot=self, in_auth=self.__auth, in_twitch_api=self.__api) if in_use_irc else None
+        # raw chat lines and eventsub notifications, written to hourly files per channel for moderation review (None to keep nothing)
+        self.__archive = ChatArchive(in_archive_directory, in_archive_compression) if in_archive_directory else None
+        # object that is managing the eventsub connections, more sessions get opened as subscriptions grow
+        self.__eventsub = EventSubPool(in_twitch_api=self.__api, in_archive=self.__archive)
+        # chat commands registered with add_command/command
+        self.__commands = CommandRouter()
+        # only build full message objects for every chat line if the bot actually wants them
+        self.__has_irc_message_handler = type(self).event_irc_message is not StashioTwitchBot.event_irc_message
+        # object that is managing the irc connections, channels get spread over more connections once one is full
+        self.__irc = IRCShardManager(in_bot=self, in_auth=self.__auth, in_twitch_api=self.__api,
+                                     in_channels_per_shard=in_irc_channels_per_shard, in_max_shards=in_irc_max_shards,
+                                     in_dispatch_workers=in_irc_dispatch_workers, in_dispatch_queue_depth=in_irc_dispatch_queue_depth,
+                                     in_max_users=in_irc_max_users, in_user_idle_ttl=in_irc_user_idle_ttl, in_max_channels=in_irc_max_channels,
+                                     in_archive=self.__archive) if in_use_irc else None
     
     @property
     def user(self):
@@ -36,40 +58,52 @@ class StashioTwitchBot():
     async def RefreshIRCAccessToken(self):
         await self.__irc.RefreshIRCAccessToken()
         
+    # Returns a future per subscription that resolves to whether it got created, await them to wait for the subscriptions
     async def channel_subscribe(self, in_channel_name, subscriptions_and_callbacks):
         id = await self.__get_channel_id(in_channel_name)
         if id:
-            await self.__eventsub.channel_subscribe(id, subscriptions_and_callbacks)
+            return await self.__eventsub.channel_subscribe(id, subscriptions_and_callbacks)
+        return []
     
     async def __get_channel_id(self, in_username):
         return await self.__user_bank.get_channel_id(in_username)
         
     async def stop(self):
         self.__manual_shutdown_requested = True
-        await self.__eventsub.stop()
-        if self.__irc:
-            await self.__irc.stop()
+        await self.__supervisor.stop(self.__stop_deadline)
+        if self.__archive:
+            await self.__archive.stop()
+        await self.__user_bank.close()
+        await self.__auth.close()
+        await self.__http.close()
         
     async def run(self):
-        # task to process eventsub websocket data
-        self.__loop.create_task(self.eventsub_loop())
+        # keeps both tokens refreshed ahead of their expiry
+        self.__auth.start()
+        if self.__archive:
+            self.__archive.start()
         
-        # task to process the irc connection
-        if self.__irc:
-            self.__loop.create_task(self.irc_loop())
+        # eventsub websocket sessions
+        self.__supervisor.add("eventsub", self.__eventsub.run, lambda: self.__eventsub.stop(self.__stop_deadline))
         
+        # irc connections
+        if self.__irc:
+            self.__supervisor.add("irc", self.__irc.run, lambda: self.__irc.stop(self.__stop_deadline))
+            
+        self.__supervisor.start()
         await self.event_initialize()
         
-        while not self.__manual_shutdown_requested:
-            await asyncio.sleep(0)
+        # sleeps until stop() is called
+        await self.__supervisor.wait()
         
-    async def eventsub_loop(self):
-        while not self.__manual_shutdown_requested:
-            await self.__eventsub.run()
+    def get_eventsub_stats(self):
+        return self.__eventsub.get_stats()
         
-    async def irc_loop(self):
-        while not self.__manual_shutdown_requested:
-            await self.__irc.run()
+    def get_archive_stats(self):
+        return self.__archive.get_stats() if self.__archive else None
+        
+    def get_supervisor_stats(self):
+        return self.__supervisor.get_stats()
 
     async def is_follower_only(self, user_obj):
         settings = await self.__api.GetChannelSettings(user_obj.channel_id)
@@ -89,8 +123,45 @@ class StashioTwitchBot():
     async def get_follower_count(self, user):
         return await self.__api.GetFollowerCount(user)
 
+    @property
+    def has_irc_message_handler(self):
+        return self.__has_irc_message_handler
+        
+    # Registers an async callback(message, args) for chat messages that start with in_name
+    def add_command(self, in_name, in_callback, in_channels=None):
+        self.__commands.add(in_name, in_callback, in_channels)
+        
+    def remove_command(self, in_name, in_channels=None):
+        self.__commands.remove(in_name, in_channels)
+        
+    # Decorator version of add_command
+    def command(self, in_name, in_channels=None):
+        def decorator(in_callback):
+            self.add_command(in_name, in_callback, in_channels)
+            return in_callback
+        return decorator
+        
+    def match_command(self, in_content, in_channel):
+        return self.__commands.match(in_content, in_channel)
+        
+    def get_api_rate_limit_stats(self):
+        return self.__api.get_rate_limit_stats()
+        
+    def get_api_cache_stats(self):
+        return self.__api.get_cache_stats()
+        
+    def get_irc_cache_stats(self):
+        return self.__irc.get_cache_stats() if self.__irc else None
+        
+    def get_irc_join_stats(self):
+        return self.__irc.join_stats if self.__irc else None
+        
+    def get_irc_dispatch_stats(self):
+        return self.__irc.dispatch_stats if self.__irc else None
+        
+    # Returns a future per channel that resolves to whether we got into it
     async def join_channels(self, channels):
-        await self.__irc.join_channels(channels)
+        return await self.__irc.join_channels(channels)
             
     async def leave_channels(self, channels):
         await self.__irc.leave_channels(channels)
@@ -106,7 +177,7 @@ class StashioTwitchBot():
     async def event_irc_message(self, message):
         pass
         
-    # This event gets called when the bot successfully authenticates to twitch
+    # This event gets called when the bot successfully authenticates to twitch (once per irc connection)
     async def event_irc_connected(self):
         pass
         
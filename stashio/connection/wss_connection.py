@@ -1,35 +1,107 @@
 import aiohttp
 import asyncio
-import datetime
-from stashio.utils.data import DelayQueue
+import time
+from stashio.utils.data import DelayQueue, LineBuffer
+from stashio.utils.supervisor import backoff_delay
 
 class BaseConnection():
-    def __init__(self, in_server):
+    def __init__(self, in_server, in_delimiter='\r\n', in_max_pending_frames=1024, in_max_send_frame_size=4096, in_min_reconnect_delay=1, in_max_reconnect_delay=60):
         # the eventsub server
         self.__server = in_server
         # the current active socket
         self.__ws = None
         # flag that will let our fibers stop
         self.__manual_shutdown_requested = False
-        # the data we've read with recv() but haven't processed yet
-        self.__data = ""
+        # frames we've read with recv() but haven't processed yet
+        self.__recv_frames = asyncio.Queue(maxsize=in_max_pending_frames)
+        # splits frames into lines and carries partial lines between frames
+        self.__line_buffer = LineBuffer(in_delimiter)
         # the data we want to send out but haven't processed yet
         self.__send_data = DelayQueue()
+        # wakes up the send task when new data gets queued
+        self.__send_wakeup = asyncio.Event()
+        # set while we have a socket that we can send on
+        self.__connected = asyncio.Event()
+        # lines that are due at the same time get joined with this into one frame
+        self.__delimiter = in_delimiter
+        # the biggest frame we'll build out of multiple lines
+        self.__max_send_frame_size = in_max_send_frame_size
         # asyncio event loop
         self.__loop = asyncio.get_event_loop()
         # force a reconnect
         self.__force_reconnect = False
+        # set while there's a reason to be connected, run() sleeps on it instead of polling
+        self.__connection_allowed = asyncio.Event()
+        self.__connection_allowed.set()
+        # set once stop() is called, wakes up anything waiting out a reconnect delay
+        self.__shutdown = asyncio.Event()
+        # seconds between connection attempts that fail, doubling up to the max
+        self.__min_reconnect_delay = in_min_reconnect_delay
+        self.__max_reconnect_delay = in_max_reconnect_delay
+        # the session sockets get opened with, only valid while run() is going
+        self.__session = None
+        # (new socket, frames already read from it) that run() switches to once the current socket closes
+        self.__handover = None
+        # monotonic time we last read anything from the socket
+        self.__last_receive_time = None
         
     async def shutdown_requested(self):
         return self.__manual_shutdown_requested
         
     async def stop(self):
         self.__manual_shutdown_requested = True
+        self.__shutdown.set()
+        # wake run() up if it's waiting to be allowed to connect, it checks for shutdown first
+        self.__connection_allowed.set()
+        if self.__ws is not None and not self.__ws.closed:
+            await self.__ws.close()
         await self.on_stop()
+        
+    # Subclasses call this when they go from having nothing to connect for to having something, or back
+    def set_connection_allowed(self, in_allowed):
+        if in_allowed:
+            self.__connection_allowed.set()
+        else:
+            self.__connection_allowed.clear()
 
+    @property
+    def last_receive_time(self):
+        return self.__last_receive_time
+        
     async def force_reconnect(self):
         print("Marked force reconnect")
         self.__force_reconnect = True
+        # a half dead socket might never give us another frame to notice the flag on
+        if self.__ws is not None and not self.__ws.closed:
+            await self.__ws.close()
+            
+    # Moves to in_url without a gap: the new socket is opened while the current one is still up, and run() switches
+    # over once we've read in_first_frames frames from it. on_disconnect/on_connect aren't called for the switch.
+    async def migrate(self, in_url, in_first_frames=1, in_timeout=10):
+        if self.__session is None:
+            return False
+            
+        new_ws = None
+        try:
+            new_ws = await self.__session.ws_connect(in_url, timeout=in_timeout)
+            frames = []
+            while len(frames) < in_first_frames:
+                rec = await new_ws.receive(timeout=in_timeout)
+                if rec.type != aiohttp.WSMsgType.TEXT:
+                    raise aiohttp.ClientError(f"Unexpected data type while migrating: {rec.type}")
+                frames.append(rec.data)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print("Failed to migrate, reconnecting instead:", repr(e))
+            if new_ws is not None:
+                await new_ws.close()
+            await self.force_reconnect()
+            return False
+            
+        self.__handover = (new_ws, frames)
+        # ends the read loop on the old socket, everything it already gave us stays ahead of the new frames
+        if self.__ws is not None and not self.__ws.closed:
+            await self.__ws.close()
+        return True
     
     async def run(self):
         # task to process the data we read from the socket
@@ -39,84 +111,180 @@ class BaseConnection():
         
         await self.on_run()
         
-        while not self.__manual_shutdown_requested:
+        try:
             async with aiohttp.ClientSession() as session:
-                if not await self.is_connection_allowed():
-                    await asyncio.sleep(0)
-                    continue
-                    
-                try:
-                    print("Connecting")
-                    async with session.ws_connect(self.__server, timeout=1) as websocket:
-                        self.__ws = websocket
+                self.__session = session
+                attempt = 0
+                while not self.__manual_shutdown_requested:
+                    if not self.__connection_allowed.is_set():
+                        await self.__connection_allowed.wait()
+                        continue
+                        
+                    try:
+                        print("Connecting")
+                        websocket = await session.ws_connect(self.__server, timeout=1)
+                    except (aiohttp.ClientConnectorError, aiohttp.WSServerHandshakeError, asyncio.TimeoutError) as e:
+                        self.__connected.clear()
+                        delay = backoff_delay(attempt, self.__min_reconnect_delay, self.__max_reconnect_delay)
+                        attempt += 1
+                        print(f"Failed to connect, trying again in {delay:.1f}s.")
+                        try:
+                            await asyncio.wait_for(self.__shutdown.wait(), delay)
+                        except asyncio.TimeoutError:
+                            pass
+                        continue
+                        
+                    attempt = 0
+                    # a partial line from the last socket will never be completed
+                    self.__line_buffer.clear()
+                    self.__ws = websocket
+                    self.__last_receive_time = time.monotonic()
+                    self.__connected.set()
+                    # on_disconnect has to run however the socket goes away, or state tied to it outlives it
+                    try:
                         await self.on_connect()
-                        async for rec in websocket:
-                            now = datetime.datetime.now()
-                            timestamp = now.strftime("%m/%d/%Y %H:%M:%S")
-                            if rec.type == aiohttp.WSMsgType.TEXT:
-                                self.__data += rec.data
-                            elif rec.type == aiohttp.WSMsgType.ERROR:
-                                print("Received error")
-                                break
-                            else:
-                                print("========================")
-                                print("Unexpected data type:",rec.type)
-                                print(rec.data)
-                                print("========================")
-                                
-                            if self.__force_reconnect:
-                                break
-                            if self.__manual_shutdown_requested:
-                                break
-                            
-                        if self.__force_reconnect:
-                            print("Forcing a reconnect")
-                            self.__force_reconnect = False
-                            continue
-                        if self.__manual_shutdown_requested:
-                            break
-                        await asyncio.sleep(0)
-                except (aiohttp.ClientConnectorError, asyncio.TimeoutError) as e:
-                    print("Failed to connect, trying again.")
-                    await asyncio.sleep(5)
-                    
-        recv_event.cancel()
-        send_event.cancel()
+                        
+                        while websocket is not None:
+                            try:
+                                await self.__read_socket(websocket)
+                            finally:
+                                await websocket.close()
+                            websocket = await self.__take_handover()
+                            if websocket is not None:
+                                self.__ws = websocket
+                                self.__connected.set()
+                    finally:
+                        self.__connected.clear()
+                        if self.__ws is not None and not self.__ws.closed:
+                            await self.__ws.close()
+                        await self.on_disconnect()
+                        
+                    if self.__force_reconnect:
+                        print("Forcing a reconnect")
+                        self.__force_reconnect = False
+                        continue
+                    if self.__manual_shutdown_requested:
+                        break
+        finally:
+            self.__session = None
+            self.__ws = None
+            self.__connected.clear()
+            recv_event.cancel()
+            send_event.cancel()
+            
+    async def __read_socket(self, websocket):
+        async for rec in websocket:
+            self.__last_receive_time = time.monotonic()
+            if rec.type == aiohttp.WSMsgType.TEXT:
+                # blocks the socket read when the receive stage falls behind
+                await self.__recv_frames.put(rec.data)
+            elif rec.type == aiohttp.WSMsgType.ERROR:
+                print("Received error")
+                break
+            else:
+                print("========================")
+                print("Unexpected data type:",rec.type)
+                print(rec.data)
+                print("========================")
+                
+            if self.__force_reconnect:
+                break
+            if self.__manual_shutdown_requested:
+                break
+                
+    async def __take_handover(self):
+        handover = self.__handover
+        self.__handover = None
+        if handover is None:
+            return None
+            
+        new_ws, frames = handover
+        # a reconnect or stop that came in meanwhile wins over the migration
+        if self.__force_reconnect or self.__manual_shutdown_requested:
+            self.__loop.create_task(new_ws.close())
+            return None
+            
+        for frame in frames:
+            await self.__recv_frames.put(frame)
+        self.__last_receive_time = time.monotonic()
+        return new_ws
         
     async def process_recv_data(self):
         while not self.__manual_shutdown_requested:
-            if len(self.__data) > 0:
-                messages = self.__data.split('\r\n')
-                self.__data = ""
-                for m in messages:
-                    if len(m) == 0:
-                        continue
-                    await self.on_receive(m)
-            await asyncio.sleep(0)
-        
+            # sleep until the socket gives us something
+            frame = await self.__recv_frames.get()
+            lines = self.__line_buffer.feed(frame)
+            
+            # grab everything else that is already waiting so it gets handled as one batch
+            while not self.__recv_frames.empty():
+                lines += self.__line_buffer.feed(self.__recv_frames.get_nowait())
+                
+            if len(lines) > 0:
+                await self.on_receive_batch(lines)
             
     async def process_send_data(self):
-        wait_queue = []
-        
         while not self.__manual_shutdown_requested:
-            try:
-                data = self.__send_data.pop()
-                if len(data) > 0:
-                    items_to_check = wait_queue + data
-                    wait_queue = []
-                    out = []
-                        
-                    for p in items_to_check:
-                        await self.__ws.send_str(p)
-                        await asyncio.sleep(0)
-                            
-            except aiohttp.ClientDisconnectedError:
+            # nothing can go out until we have a socket
+            if not self.__connected.is_set():
+                await self.__connected.wait()
+                continue
+                
+            # clear before popping so data added after the pop still wakes us up
+            self.__send_wakeup.clear()
+            lines = self.__send_data.pop()
+            
+            if len(lines) == 0:
+                # sleep until the next delayed send is due or someone queues more data
+                next_time = self.__send_data.get_next_time()
+                timeout = max(0, next_time - time.time()) if next_time is not None else None
+                try:
+                    await asyncio.wait_for(self.__send_wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
                 continue
                 
-            await asyncio.sleep(0)
+            frames = self.__build_frames(lines)
+            for i in range(len(frames)):
+                frame_lines, frame = frames[i]
+                try:
+                    await self.__ws.send_str(frame)
+                except (ConnectionResetError, aiohttp.ClientError):
+                    # put back everything we didn't get out so it goes out after a reconnect
+                    for unsent_lines, _ in frames[i:]:
+                        for line in unsent_lines:
+                            self.__send_data.add(line, 0)
+                    self.__connected.clear()
+                    break
+                    
+    def __build_frames(self, lines):
+        # without a delimiter every line needs its own frame
+        if not self.__delimiter:
+            return [([line], line) for line in lines]
             
+        frames = []
+        current = []
+        current_size = 0
+        for line in lines:
+            added_size = len(line) + (len(self.__delimiter) if current else 0)
+            if current and current_size + added_size > self.__max_send_frame_size:
+                frames.append((current, self.__delimiter.join(current)))
+                current = []
+                current_size = 0
+                added_size = len(line)
+            current.append(line)
+            current_size += added_size
+            
+        if current:
+            frames.append((current, self.__delimiter.join(current)))
+        return frames
+        
+    # Drops queued lines that haven't gone out yet, returns how many were dropped
+    def discard_unsent(self, in_predicate):
+        return self.__send_data.remove_if(in_predicate)
+        
     async def send(self, in_data, in_delay = 0):
         self.__send_data.add(in_data, in_delay)
+        self.__send_wakeup.set()
         
     async def on_run(self):
         pass
@@ -127,8 +295,12 @@ class BaseConnection():
     async def on_connect(self):
         pass
         
-    async def on_receive(self, data):
+    async def on_disconnect(self):
         pass
         
-    async def is_connection_allowed(self):
-        return True
\ No newline at end of file
+    async def on_receive_batch(self, lines):
+        for line in lines:
+            await self.on_receive(line)
+        
+    async def on_receive(self, data):
+        pass
@@ -1,6 +1,15 @@
+from stashio.utils.data import TTLCache
 
 class RoomState():
+    __slots__ = ("__channel", "__channel_id", "__is_emote_only", "__is_followers_only", "__slow_mode", "__is_subs_only")
+    
     def __init__(self, in_room_state_packet):
+        self.__channel = None
+        self.__channel_id = 0
+        self.__is_emote_only = False
+        self.__is_followers_only = False
+        self.__slow_mode = 0
+        self.__is_subs_only = False
         self.update_state(in_room_state_packet)
         
     def __repr__(self):
@@ -11,14 +20,15 @@ class RoomState():
             self.__channel = in_room_state_packet.channel
         if in_room_state_packet.channel_id:
             self.__channel_id = in_room_state_packet.channel_id
-        if "emote-only" in in_room_state_packet.message:
-            self.__is_emote_only = in_room_state_packet.message["emote-only"] == '1'
-        if "followers-only" in in_room_state_packet.message:
-            self.__is_followers_only = in_room_state_packet.message["followers-only"] == '1'
-        if "slow" in in_room_state_packet.message:
-            self.__slow_mode = int(in_room_state_packet.message["slow"])
-        if "subs-only" in in_room_state_packet.message:
-            self.__is_subs_only = in_room_state_packet.message["subs-only"] == '1'
+        tags = in_room_state_packet.tags
+        if "emote-only" in tags:
+            self.__is_emote_only = tags["emote-only"] == '1'
+        if "followers-only" in tags:
+            self.__is_followers_only = tags["followers-only"] == '1'
+        if "slow" in tags:
+            self.__slow_mode = int(tags["slow"])
+        if "subs-only" in tags:
+            self.__is_subs_only = tags["subs-only"] == '1'
         
     @property
     def channel(self):
@@ -45,7 +55,11 @@ class RoomState():
         return self.__is_subs_only
 
 class UserState():
+    __slots__ = ("__channel", "__badges", "__is_mod", "__is_subscriber")
+    
     def __init__(self, in_user_state_packet):
+        self.__channel = None
+        self.__badges = None
         self.update_state(in_user_state_packet)
         
     def __repr__(self):
@@ -76,6 +90,8 @@ class UserState():
         return self.__badges
         
 class Channel():
+    __slots__ = ("__channel_id", "__send_callback", "__user_state", "__room_state")
+    
     def __init__(self, in_channel_id, in_send_callback):
         self.__channel_id = in_channel_id
         self.__send_callback = in_send_callback
@@ -143,25 +159,38 @@ class Channel():
         return self.__room_state.is_subs_only if self.__room_state else False
 
 class ChannelManager():
-    def __init__(self, in_send_callback):
-        self.__channel_cache = dict()
+    def __init__(self, in_send_callback, in_twitch_api=None, in_max_channels=10000, in_idle_ttl=None):
+        # channel id -> Channel, the least recently used go first once we're full or they've been quiet too long
+        self.__channel_cache = TTLCache(in_max_channels, in_idle_ttl, in_refresh_on_access=True)
         self.__send_callback = in_send_callback
+        # room state updates make cached chat settings stale
+        self.__api = in_twitch_api
+        
+    def get_cache_stats(self):
+        return self.__channel_cache.get_stats()
         
     def __add_or_find_channel(self, in_channel_id):
-        if not in_channel_id in self.__channel_cache:
-            self.__channel_cache[in_channel_id] = Channel(in_channel_id, self.__send_callback)
-        return self.__channel_cache[in_channel_id]
+        channel = self.__channel_cache.get(in_channel_id)
+        if channel is None:
+            channel = Channel(in_channel_id, self.__send_callback)
+            self.__channel_cache.set(in_channel_id, channel)
+        return channel
         
     async def set_channel_user_state(self, in_user_state):
         chan = self.__add_or_find_channel(in_user_state.channel_id)
         return chan.update_user_state(in_user_state)
         
     async def set_channel_room_state(self, in_room_state):
+        self.__channel_cache.prune()
         chan = self.__add_or_find_channel(in_room_state.channel_id)
+        if self.__api:
+            self.__api.invalidate_channel_settings(in_room_state.channel_id)
         return chan.update_room_state(in_room_state)
         
     async def get_channel(self, in_channel_id):
-        return self.__channel_cache[in_channel_id] if in_channel_id in self.__channel_cache else None
+        return self.__channel_cache.get(in_channel_id)
 
     def is_mod(self, in_channel_id):
-        return self.__channel_cache[in_channel_id].is_mod if in_channel_id in self.__channel_cache else False
+        # doesn't count as a use, the rate limiter asks about every message we send
+        channel = self.__channel_cache.peek(in_channel_id)
+        return channel.is_mod if channel else False
@@ -1,34 +1,72 @@
 import asyncio
-import traceback
 from stashio.utils.auth import Auth
 from stashio.irc.channel_manager import ChannelManager
 from stashio.irc.user_manager import UserManager
 from stashio.irc.types import TwitchMessage, IRCData, IRCPackets
+from stashio.irc.rate_limiter import RateLimitScheduler
+from stashio.irc.join_manager import JoinManager, JOIN_FAILED_NOTICES
 from stashio.connection.wss_connection import BaseConnection
+from stashio.utils.dispatch import DispatchPool
 from stashio.twitch.api import TwitchApi
 
+# chat lines and the moderation actions taken on them
+ARCHIVED_COMMANDS = {"PRIVMSG", "USERNOTICE", "CLEARCHAT", "CLEARMSG"}
+
 class IRC(BaseConnection):
-    def __init__(self, in_bot, in_auth, in_twitch_api: TwitchApi, in_server='wss://irc-ws.chat.twitch.tv:443'):
+    def __init__(self, in_bot, in_auth, in_twitch_api: TwitchApi, in_server='wss://irc-ws.chat.twitch.tv:443', in_dispatch_workers=8, in_dispatch_queue_depth=256,
+                 in_user_manager=None, in_channel_manager=None, in_rate_budget=None, in_archive=None):
         super().__init__(in_server)
         # auth data
         self.__auth = in_auth
         # twitch api interface
         self.__api = in_twitch_api
-        # manages user objects that contain info about the user and its roles in channels
-        self.__user_manager = UserManager()
-        # manages channel objects that contain info about the channel and the bot's roles in the channel
-        self.__channel_manager = ChannelManager(self.__message_send_callback)
+        # manages user objects that contain info about the user and its roles in channels (can be shared between connections)
+        self.__user_manager = in_user_manager if in_user_manager else UserManager()
+        # manages channel objects that contain info about the channel and the bot's roles in the channel (can be shared between connections)
+        self.__channel_manager = in_channel_manager if in_channel_manager else ChannelManager(self.send_message, in_twitch_api)
+        # holds back chat messages and joins until they fit in twitch's rate limits, the budget is per account so it can be shared
+        self.__scheduler = RateLimitScheduler(self.send, self.__channel_manager.is_mod, in_rate_budget)
+        # the channels this connection should be in, rejoined after every reconnect
+        self.__join_manager = JoinManager(self.__scheduler)
         # asyncio event loop
         self.__loop = asyncio.get_event_loop()
         # the bot, for calling events
         self.__bot = in_bot
+        # irc command -> handler
+        self.__packet_handlers = {
+            "001": self.__on_welcome,
+            "PING": self.__on_ping,
+            "PRIVMSG": self.__on_privmsg,
+            # TODO: Right now joins only give a channel name, so need a lookup by name for user and channel
+            #"JOIN": self.__on_join,
+            "USERSTATE": self.__on_userstate,
+            "ROOMSTATE": self.__on_roomstate,
+            "NOTICE": self.__on_notice
+        }
+        # raw lines for ARCHIVED_COMMANDS get copied here for moderation review (can be shared between connections)
+        self.__archive = in_archive
+        # runs packet handlers with a fixed number of workers, keeping the order of packets within a channel
+        self.__dispatch = DispatchPool(self.process_irc_packet, in_dispatch_workers, in_dispatch_queue_depth)
         
     #############################################################
     ## Start BaseConnection overrides
     #############################################################        
+    async def on_run(self):
+        self.__scheduler.start()
+        self.__dispatch.start()
+        
+    async def on_stop(self):
+        self.__scheduler.stop()
+        self.__dispatch.stop()
+        
+    async def on_disconnect(self):
+        self.__join_manager.on_disconnect()
+        # joins that made it to the socket queue would go out ahead of our login
+        self.discard_unsent(lambda line: line.startswith("JOIN "))
+        
     async def on_connect(self):
         await self.send(f"CAP REQ :twitch.tv/commands twitch.tv/tags")
-        await self.send(f"PASS {self.__auth.get_irc_token()}")
+        await self.send(f"PASS {await self.__auth.get_valid_irc_token()}")
         await asyncio.sleep(0.1)
         await self.send(f"NICK {self.__auth.get_user()}")
         
@@ -41,61 +79,88 @@ class IRC(BaseConnection):
             print("Exception:",str(e))
             print("Message:",data)
             print("==================================")
+            return
             
-        try:
-            #await self.process_irc_packet(m)
-            self.__loop.create_task(self.process_irc_packet(m))
-        except Exception as e:
-            print("==================================")
-            print("EXCEPTION PROCESSING IRC PACKET!")
-            print("Exception:",str(e))
-            print("Message:",data)
-            print("Message object:",m)
-            print("==================================")
+        if self.__archive and m.channel and m.command in ARCHIVED_COMMANDS:
+            self.__archive.write("irc", m.channel, data)
+            
+        # blocks when this channel's queue is full, which holds up the socket read
+        await self.__dispatch.submit(m.channel or "", m)
             
     #############################################################
     ## End BaseConnection overrides
     #############################################################
 
+    @property
+    def dispatch_stats(self):
+        return self.__dispatch.get_stats()
+        
+    @property
+    def join_stats(self):
+        return self.__join_manager.get_stats()
+        
+    @property
+    def joined_channels(self):
+        return self.__join_manager.joined_channels
+        
     async def process_irc_packet(self, message):
-        if message.command == "001":
-            await self.__bot.event_irc_connected()
-        elif message.command == "PING":
-            await self.send(f"PONG :{message.content}")
-        elif message.command == "PRIVMSG":
-            await self.__user_manager.set_user_data(message)
-            user = await self.__user_manager.get_user(message.user_id)
-            channel = await self.__channel_manager.get_channel(message.channel_id)
-            await self.__bot.event_irc_message(TwitchMessage(channel, user, message, self.__message_reply_callback))
-        elif message.command == "JOIN":
-            # TODO: Right now joins only give a channel name, so need a lookup by name for user and channel
-            #await self.event_irc_join(TwitchChannel(message))
-            pass
-        elif message.command == "USERSTATE":
-            updated_channel = await self.__channel_manager.set_channel_user_state(message)
-            await self.__bot.event_irc_userstate(updated_channel)
-        elif message.command == "ROOMSTATE":
-            updated_channel = await self.__channel_manager.set_channel_room_state(message)
-            await self.__bot.event_irc_roomstate(updated_channel)
-        elif message.command == "NOTICE":
-            await self.__bot.event_irc_notice(message.channel, message.content)
+        handler = self.__packet_handlers.get(message.command)
+        if handler:
+            await handler(message)
+            
+    async def __on_welcome(self, message):
+        await self.__join_manager.on_ready()
+        await self.__bot.event_irc_connected()
+        
+    async def __on_ping(self, message):
+        await self.send(f"PONG :{message.content}")
+        
+    async def __on_privmsg(self, message):
+        user = await self.__user_manager.set_user_data(message)
+        
+        command = self.__bot.match_command(message.content, message.channel)
+        wants_message = self.__bot.has_irc_message_handler
+        # most chat is neither a command nor wanted by the bot, so don't build anything for it
+        if not command and not wants_message:
+            return
+            
+        channel = await self.__channel_manager.get_channel(message.channel_id)
+        twitch_message = TwitchMessage(channel, user, message, self.__message_reply_callback)
+        
+        if wants_message:
+            await self.__bot.event_irc_message(twitch_message)
+        if command:
+            callback, args = command
+            await callback(twitch_message, args)
+            
+    async def __on_userstate(self, message):
+        updated_channel = await self.__channel_manager.set_channel_user_state(message)
+        await self.__bot.event_irc_userstate(updated_channel)
+        
+    async def __on_roomstate(self, message):
+        self.__join_manager.on_roomstate(message.channel)
+        updated_channel = await self.__channel_manager.set_channel_room_state(message)
+        await self.__bot.event_irc_roomstate(updated_channel)
+        
+    async def __on_notice(self, message):
+        if message.msg_id == "msg_ratelimit":
+            self.__scheduler.on_rate_limited(message.channel)
+        elif message.msg_id in JOIN_FAILED_NOTICES:
+            self.__join_manager.on_join_failed(message.channel)
+        await self.__bot.event_irc_notice(message.channel, message.content)
             
     async def __message_reply_callback(self, in_message_id, in_channel, in_message, in_delay = 0):
-        await self.send(IRCPackets.Message(in_channel, in_message, in_message_id).get(), in_delay)
+        await self.__scheduler.add(IRCPackets.Message(in_channel, in_message, in_message_id), in_delay)
         
-    async def __message_send_callback(self, in_channel, in_message, in_delay = 0):
-        await self.send(IRCPackets.Message(in_channel, in_message).get(), in_delay)
+    async def send_message(self, in_channel, in_message, in_delay = 0):
+        await self.__scheduler.add(IRCPackets.Message(in_channel, in_message), in_delay)
 
+    # Returns a future per channel that resolves to whether we got into it
     async def join_channels(self, channels):
-        try:
-            for channel in channels:
-                await self.send(IRCPackets.Join(channel).get(), 0)
-        except Exception as e:
-            traceback.print_exc()
+        return await self.__join_manager.join(channels)
             
     async def leave_channels(self, channels):
-        for channel in channels:
-            await self.send(IRCPackets.Part(channel).get(), 0)
+        await self.__join_manager.leave(channels)
         
     async def RefreshIRCAccessToken(self):
         await self.__api.RefreshIRCAccessToken()
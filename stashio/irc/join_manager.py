@@ -0,0 +1,150 @@
+import asyncio
+import time
+from stashio.irc.types import IRCPackets
+from stashio.utils.data import TimingStats
+
+# notices twitch sends instead of a ROOMSTATE when a join can't happen
+JOIN_FAILED_NOTICES = {"msg_channel_suspended", "msg_banned", "tos_ban", "msg_room_not_found"}
+
+class JoinManager():
+    def __init__(self, in_scheduler):
+        # joins go out through the scheduler so they stay inside the join budget
+        self.__scheduler = in_scheduler
+        # channels we want to be in, whether or not we're in them right now
+        self.__desired = set()
+        # channels twitch sent a ROOMSTATE for on the current connection
+        self.__joined = set()
+        # channel -> monotonic time its JOIN was queued, for joins that haven't been confirmed yet
+        self.__queued = dict()
+        # channel -> future that resolves to whether the join worked
+        self.__futures = dict()
+        # joins only work once twitch has accepted our login
+        self.__ready = False
+        self.__was_ready = False
+        # monotonic time the current batch of joins started, until everything in it is confirmed
+        self.__wave_started_at = None
+        self.__loop = asyncio.get_event_loop()
+        # counters
+        self.__join_times = TimingStats()
+        self.__all_joined_times = TimingStats()
+        self.__failed = 0
+        self.__rejoins = 0
+
+    @property
+    def desired_channels(self):
+        return set(self.__desired)
+
+    @property
+    def joined_channels(self):
+        return set(self.__joined)
+
+    def get_stats(self):
+        return {
+            "desired": len(self.__desired),
+            "joined": len(self.__joined),
+            "pending": len(self.__queued),
+            "failed": self.__failed,
+            "rejoins": self.__rejoins,
+            "join": self.__join_times.get_stats(),
+            "all_joined": self.__all_joined_times.get_stats()
+        }
+
+    def __normalize(self, in_channel):
+        return in_channel.lower().lstrip('#')
+
+    # Returns a future per channel that resolves to whether we got into it
+    async def join(self, in_channels):
+        futures = []
+        for channel in in_channels:
+            name = self.__normalize(channel)
+            self.__desired.add(name)
+            future = self.__futures.get(name)
+            if future is None:
+                future = self.__futures[name] = self.__loop.create_future()
+                if name in self.__joined:
+                    future.set_result(True)
+            futures.append(future)
+
+            if self.__ready and not name in self.__joined and not name in self.__queued:
+                await self.__queue_join(name)
+        return futures
+
+    async def leave(self, in_channels):
+        for channel in in_channels:
+            name = self.__normalize(channel)
+            if not name in self.__desired:
+                continue
+
+            self.__desired.discard(name)
+            self.__joined.discard(name)
+            self.__resolve(name, False)
+            # a JOIN still waiting on the budget would go out after the PART and put us back in the channel
+            if self.__queued.pop(name, None) is not None:
+                if self.__scheduler.discard(IRCPackets.QueueType.JOIN, lambda packet, name=name: packet.channel == name) > 0:
+                    continue
+            await self.__scheduler.add(IRCPackets.Part(name), 0)
+        self.__check_wave_done()
+
+    # Call once twitch accepts our login, everything we want gets joined as fast as the budget allows
+    async def on_ready(self):
+        self.__ready = True
+        missing = [name for name in self.__desired if not name in self.__joined and not name in self.__queued]
+        if self.__was_ready and len(missing) > 0:
+            self.__rejoins += 1
+        self.__was_ready = True
+        for name in missing:
+            await self.__queue_join(name)
+
+    # Call when the socket goes away, twitch forgets our channels with it
+    def on_disconnect(self):
+        self.__ready = False
+        # joins still waiting on the budget would go out before we log back in, the rejoin sends them again
+        self.__scheduler.discard(IRCPackets.QueueType.JOIN)
+        self.__joined = set()
+        self.__queued = dict()
+        self.__wave_started_at = None
+        # the channels we were in get a new future, so anyone waiting from now on waits for the rejoin
+        for name, future in list(self.__futures.items()):
+            if future.done():
+                del self.__futures[name]
+
+    def on_roomstate(self, in_channel):
+        name = self.__normalize(in_channel)
+        # a ROOMSTATE for a channel we're already in is just a setting changing
+        if not name in self.__desired or name in self.__joined:
+            return
+
+        self.__joined.add(name)
+        queued_at = self.__queued.pop(name, None)
+        if queued_at is not None:
+            self.__join_times.add(time.monotonic() - queued_at)
+        self.__resolve(name, True)
+        self.__check_wave_done()
+
+    def on_join_failed(self, in_channel):
+        name = self.__normalize(in_channel)
+        if not name in self.__queued:
+            return
+
+        self.__failed += 1
+        self.__queued.pop(name, None)
+        self.__desired.discard(name)
+        self.__resolve(name, False)
+        self.__check_wave_done()
+
+    async def __queue_join(self, in_name):
+        now = time.monotonic()
+        if self.__wave_started_at is None:
+            self.__wave_started_at = now
+        self.__queued[in_name] = now
+        await self.__scheduler.add(IRCPackets.Join(in_name), 0)
+
+    def __resolve(self, in_name, in_result):
+        future = self.__futures.pop(in_name, None) if not in_result else self.__futures.get(in_name)
+        if future is not None and not future.done():
+            future.set_result(in_result)
+
+    def __check_wave_done(self):
+        if self.__wave_started_at is not None and len(self.__queued) == 0:
+            self.__all_joined_times.add(time.monotonic() - self.__wave_started_at)
+            self.__wave_started_at = None
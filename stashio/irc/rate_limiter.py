@@ -0,0 +1,182 @@
+import asyncio
+import time
+import traceback
+from collections import deque
+from stashio.irc.types import IRCPackets
+from stashio.utils.data import DelayQueue, TimedCountQueue, TimedCountDataQueue
+
+class RateLimits():
+    # chat messages an account can send per window when it isn't a mod in the channel
+    PRIVMSG_LIMIT = 20
+    # chat messages an account can send per window when it is a mod or the broadcaster
+    PRIVMSG_MOD_LIMIT = 100
+    PRIVMSG_WINDOW = 30
+    # non-mods also can't send more than one message per second in the same channel
+    PRIVMSG_CHANNEL_LIMIT = 1
+    PRIVMSG_CHANNEL_WINDOW = 1
+    # join attempts an account can make per window
+    JOIN_LIMIT = 20
+    JOIN_WINDOW = 10
+    # how long to hold back a channel after twitch tells us we went over
+    RATE_LIMITED_COOLDOWN = 5
+
+class ChatRateBudget():
+    def __init__(self, in_limits=RateLimits):
+        self.__limits = in_limits
+        # every chat message we sent in the account window, tagged with its channel
+        self.__privmsgs = TimedCountDataQueue()
+        # chat messages sent in the short per channel window, tagged with the channel
+        self.__channel_privmsgs = TimedCountDataQueue()
+        # join attempts in the join window
+        self.__joins = TimedCountQueue()
+        # channel name -> time we can send to it again after a msg_ratelimit notice
+        self.__cooldowns = dict()
+
+    def on_rate_limited(self, in_channel):
+        self.__cooldowns[in_channel] = time.time() + self.__limits.RATE_LIMITED_COOLDOWN
+
+    def is_privmsg_exhausted(self):
+        # even a mod can't send anything else right now
+        return self.__privmsgs.get_count() >= self.__limits.PRIVMSG_MOD_LIMIT
+
+    # Returns 0 if the budget was taken, otherwise the seconds until it's worth trying again
+    def try_acquire_privmsg(self, in_channel, in_is_mod):
+        now = time.time()
+
+        cooldown = self.__cooldowns.get(in_channel)
+        if cooldown:
+            if cooldown > now:
+                return cooldown - now
+            del self.__cooldowns[in_channel]
+
+        limit = self.__limits.PRIVMSG_MOD_LIMIT if in_is_mod else self.__limits.PRIVMSG_LIMIT
+        if self.__privmsgs.get_count() >= limit:
+            return self.__wait_time(self.__privmsgs.get_next_expire_time(), now)
+
+        if not in_is_mod:
+            if self.__channel_privmsgs.get_count(in_channel) >= self.__limits.PRIVMSG_CHANNEL_LIMIT:
+                return self.__wait_time(self.__channel_privmsgs.get_next_expire_time(in_channel), now)
+
+        self.__privmsgs.add(in_channel, 1, self.__limits.PRIVMSG_WINDOW)
+        self.__channel_privmsgs.add(in_channel, 1, self.__limits.PRIVMSG_CHANNEL_WINDOW)
+        return 0
+
+    def try_acquire_join(self):
+        now = time.time()
+        if self.__joins.get_count() >= self.__limits.JOIN_LIMIT:
+            return self.__wait_time(self.__joins.get_next_expire_time(), now)
+        self.__joins.add(1, self.__limits.JOIN_WINDOW)
+        return 0
+
+    def __wait_time(self, in_expire_time, in_now):
+        # entries are pruned once they are strictly older than now, so never ask for a 0 second wait
+        return max(in_expire_time - in_now, 0) + 0.001 if in_expire_time else 0.001
+
+class RateLimitScheduler():
+    def __init__(self, in_send_callback, in_is_mod_callback, in_budget=None):
+        # called with the raw packet string once it is allowed to go out
+        self.__send_callback = in_send_callback
+        # channel id -> whether we are a mod there
+        self.__is_mod_callback = in_is_mod_callback
+        # token budgets, can be shared between connections on the same account
+        self.__budget = in_budget if in_budget else ChatRateBudget()
+        # packets that were asked to go out later
+        self.__delayed = DelayQueue()
+        # packets that are due, in the order they became due
+        self.__ready = deque()
+        # wakes up the release task when something gets added
+        self.__wakeup = asyncio.Event()
+        # the running release task
+        self.__task = None
+
+    @property
+    def budget(self):
+        return self.__budget
+
+    def start(self):
+        if not self.__task or self.__task.done():
+            self.__task = asyncio.get_event_loop().create_task(self.run())
+
+    def stop(self):
+        if self.__task:
+            self.__task.cancel()
+            self.__task = None
+
+    async def add(self, in_packet, in_delay = 0):
+        self.__delayed.add(in_packet, in_delay)
+        self.__wakeup.set()
+
+    def on_rate_limited(self, in_channel):
+        self.__budget.on_rate_limited(in_channel)
+        self.__wakeup.set()
+
+    # Drops queued packets of in_queue_type (that in_predicate accepts, if given) that haven't gone out yet, returns how many were dropped
+    def discard(self, in_queue_type, in_predicate=None):
+        matches = lambda packet: packet.queue_type() == in_queue_type and (in_predicate is None or in_predicate(packet))
+        removed = self.__delayed.remove_if(matches)
+        kept = deque(packet for packet in self.__ready if not matches(packet))
+        removed += len(self.__ready) - len(kept)
+        self.__ready = kept
+        return removed
+
+    async def run(self):
+        while True:
+            self.__wakeup.clear()
+            self.__ready.extend(self.__delayed.pop())
+
+            try:
+                budget_wait = await self.__release()
+            except Exception as e:
+                traceback.print_exc()
+                budget_wait = None
+
+            # sleep until budget frees up, a delayed packet is due, or a new packet is added
+            timeout = budget_wait
+            next_time = self.__delayed.get_next_time()
+            if next_time is not None:
+                delayed_wait = max(next_time - time.time(), 0)
+                timeout = min(timeout, delayed_wait) if timeout is not None else delayed_wait
+            try:
+                await asyncio.wait_for(self.__wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def __release(self):
+        still_waiting = deque()
+        # channels (or whole queue types) that are out of budget, so later packets keep their order
+        blocked = set()
+        soonest = None
+
+        while len(self.__ready) > 0:
+            packet = self.__ready.popleft()
+            queue_type = packet.queue_type()
+
+            if queue_type == IRCPackets.QueueType.PRIVMSG:
+                channel = packet.channel
+                key = (queue_type, channel.name)
+                if queue_type in blocked or key in blocked:
+                    still_waiting.append(packet)
+                    continue
+
+                wait = self.__budget.try_acquire_privmsg(channel.name, self.__is_mod_callback(channel.channel_id))
+                if wait > 0:
+                    still_waiting.append(packet)
+                    blocked.add(queue_type if self.__budget.is_privmsg_exhausted() else key)
+                    soonest = min(soonest, wait) if soonest is not None else wait
+                    continue
+            elif queue_type == IRCPackets.QueueType.JOIN:
+                if queue_type in blocked:
+                    still_waiting.append(packet)
+                    continue
+
+                wait = self.__budget.try_acquire_join()
+                if wait > 0:
+                    still_waiting.append(packet)
+                    blocked.add(queue_type)
+                    soonest = min(soonest, wait) if soonest is not None else wait
+                    continue
+
+            await self.__send_callback(packet.get())
+
+        self.__ready = still_waiting
+        return soonest
@@ -0,0 +1,151 @@
+import asyncio
+from stashio.irc.irc import IRC
+from stashio.irc.channel_manager import ChannelManager
+from stashio.irc.user_manager import UserManager
+from stashio.irc.rate_limiter import ChatRateBudget
+from stashio.utils.supervisor import Supervisor
+
+class IRCShardManager():
+    def __init__(self, in_bot, in_auth, in_twitch_api, in_channels_per_shard=None, in_max_shards=None, in_server='wss://irc-ws.chat.twitch.tv:443', in_dispatch_workers=8, in_dispatch_queue_depth=256,
+                 in_max_users=500000, in_user_idle_ttl=6*60*60, in_max_channels=10000, in_archive=None):
+        # the bot, every shard calls the same hooks on it
+        self.__bot = in_bot
+        # auth data
+        self.__auth = in_auth
+        # twitch api interface
+        self.__api = in_twitch_api
+        # how many channels a single connection gets before we open another one (None for no limit)
+        self.__channels_per_shard = in_channels_per_shard
+        # the most connections we'll open (None for no limit)
+        self.__max_shards = in_max_shards
+        # settings passed to every shard
+        self.__server = in_server
+        self.__dispatch_workers = in_dispatch_workers
+        self.__dispatch_queue_depth = in_dispatch_queue_depth
+        # state shared by every shard
+        self.__user_manager = UserManager(in_max_users, in_user_idle_ttl)
+        self.__channel_manager = ChannelManager(self.__message_send_callback, in_twitch_api, in_max_channels)
+        # chat limits are per account, so every shard draws from the same budget
+        self.__rate_budget = ChatRateBudget()
+        # every shard copies chat lines into the same archive
+        self.__archive = in_archive
+        # the connections, and the channels each one is in
+        self.__shards = []
+        self.__shard_channels = []
+        # channel name -> the shard that joined it
+        self.__channel_to_shard = dict()
+        # keeps every shard connected on its own, restarting any that crash
+        self.__supervisor = Supervisor()
+        # asyncio event loop
+        self.__loop = asyncio.get_event_loop()
+
+    @property
+    def shards(self):
+        return list(self.__shards)
+
+    @property
+    def dispatch_stats(self):
+        return [shard.dispatch_stats for shard in self.__shards]
+
+    def get_cache_stats(self):
+        return {"users": self.__user_manager.get_cache_stats(), "channels": self.__channel_manager.get_cache_stats()}
+
+    @property
+    def join_stats(self):
+        return [shard.join_stats for shard in self.__shards]
+
+    def get_shard_channel_counts(self):
+        return [len(channels) for channels in self.__shard_channels]
+
+    async def run(self):
+        # always have one connection so the bot gets connected even before it joins anything
+        if len(self.__shards) == 0:
+            self.__add_shard()
+        self.__supervisor.start()
+        await self.__supervisor.wait()
+
+    async def stop(self, in_deadline=10):
+        await self.__supervisor.stop(in_deadline)
+
+    # Returns a future per channel that resolves to whether we got into it
+    async def join_channels(self, channels):
+        names = [self.__normalize(channel) for channel in channels]
+        per_shard = dict()
+        for name in names:
+            shard = self.__channel_to_shard.get(name)
+            if shard is None:
+                index = self.__pick_shard()
+                self.__shard_channels[index].add(name)
+                self.__channel_to_shard[name] = self.__shards[index]
+            else:
+                index = self.__shards.index(shard)
+            per_shard.setdefault(index, []).append(name)
+
+        futures = dict()
+        for index, shard_names in per_shard.items():
+            shard_futures = await self.__shards[index].join_channels(shard_names)
+            futures.update(zip(shard_names, shard_futures))
+        return [futures[name] for name in names]
+
+    async def leave_channels(self, channels):
+        per_shard = dict()
+        for channel in channels:
+            name = self.__normalize(channel)
+            shard = self.__channel_to_shard.pop(name, None)
+            if shard is None:
+                continue
+
+            index = self.__shards.index(shard)
+            self.__shard_channels[index].discard(name)
+            per_shard.setdefault(index, []).append(name)
+
+        for index, names in per_shard.items():
+            await self.__shards[index].leave_channels(names)
+
+    async def RefreshIRCAccessToken(self):
+        # one refresh for the account, then every shard reconnects with the new token
+        await self.__api.RefreshIRCAccessToken()
+        for shard in self.__shards:
+            await shard.force_reconnect()
+
+    def __normalize(self, in_channel):
+        return in_channel.lower().lstrip('#')
+
+    def __pick_shard(self):
+        # least loaded shard that still has room
+        best = None
+        for i in range(len(self.__shard_channels)):
+            count = len(self.__shard_channels[i])
+            if self.__channels_per_shard is not None and count >= self.__channels_per_shard:
+                continue
+            if best is None or count < len(self.__shard_channels[best]):
+                best = i
+
+        if best is not None:
+            return best
+
+        if self.__max_shards is None or len(self.__shards) < self.__max_shards:
+            self.__add_shard()
+            return len(self.__shards) - 1
+
+        # out of shards, so go over the cap on whichever has the fewest channels
+        print("All IRC shards are full, going over the channel cap")
+        counts = self.get_shard_channel_counts()
+        return counts.index(min(counts))
+
+    def __add_shard(self):
+        shard = IRC(in_bot=self.__bot, in_auth=self.__auth, in_twitch_api=self.__api, in_server=self.__server,
+                    in_dispatch_workers=self.__dispatch_workers, in_dispatch_queue_depth=self.__dispatch_queue_depth,
+                    in_user_manager=self.__user_manager, in_channel_manager=self.__channel_manager, in_rate_budget=self.__rate_budget,
+                    in_archive=self.__archive)
+        self.__shards.append(shard)
+        self.__shard_channels.append(set())
+        self.__supervisor.add(f"irc-{len(self.__shards)}", shard.run, shard.stop)
+        return shard
+
+    async def __message_send_callback(self, in_channel, in_message, in_delay = 0):
+        # messages have to go out on the connection that joined the channel
+        shard = self.__channel_to_shard.get(in_channel.name) if in_channel.name else None
+        if shard is None:
+            shard = self.__shards[0]
+        await shard.send_message(in_channel, in_message, in_delay)
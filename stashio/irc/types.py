@@ -1,82 +1,188 @@
 import re
 
+# leading command characters that we don't let through in chat messages
+SLASH_PREFIX_PATTERN = re.compile(r"^(/\s*)+")
+DOT_PREFIX_PATTERN = re.compile(r"^(\.\s*)+")
+# commands that are followed by the channel they happened in
+CHANNEL_COMMANDS = frozenset(["JOIN", "PART", "NOTICE", "CLEARCHAT", "CLEARMSG", "HOSTTARGET", "PRIVMSG", "USERNOTICE", "USERSTATE", "ROOMSTATE", "001"])
+# commands that only carry content
+CONTENT_COMMANDS = frozenset(["PING", "GLOBALUSERSTATE", "RECONNECT"])
+# /me messages come in wrapped in a CTCP ACTION
+ACTION_PREFIX = "\x01ACTION "
+ACTION_SUFFIX = "\x01"
+# channel id -> the one int object everything tracking that channel shares
+INTERNED_CHANNEL_IDS = dict()
+
+# Every user/channel object for a channel holds the same id object instead of its own copy
+def intern_channel_id(in_channel_id):
+    return INTERNED_CHANNEL_IDS.setdefault(in_channel_id, in_channel_id)
+
 class IRCData():
+    # only the raw pieces get split up front, tags/badges/emotes are decoded the first time they are used
+    __slots__ = ("__raw_tags", "__raw_source", "__command", "__channel", "__content", "__ack", "__capabilities", "__tags", "__badges", "__emotes", "__source")
+    
     def __init__(self, in_raw_message):
         #initialization
-        self.message = dict()
-        
-        #parse
-        pattern = "^(?P<tags>@[^ ]+)? ?(?P<source>:[^ ]+)? ?(?P<command>[^:]+):?(?P<params>.+?)?$"
-        m = re.fullmatch(pattern, in_raw_message)
-        if not m:
+        self.__raw_tags = None
+        self.__raw_source = None
+        self.__command = None
+        self.__channel = None
+        self.__content = None
+        self.__ack = None
+        self.__capabilities = None
+        self.__tags = None
+        self.__badges = None
+        self.__emotes = None
+        self.__source = None
+        
+        #split
+        rest = in_raw_message
+        if rest.startswith('@'):
+            space = rest.find(' ')
+            if space < 0:
+                self.__raw_tags = rest[1:]
+                rest = ""
+            else:
+                self.__raw_tags = rest[1:space]
+                rest = rest[space + 1:]
+                
+        if rest.startswith(':'):
+            space = rest.find(' ')
+            if space < 0:
+                self.__raw_source = rest[1:]
+                rest = ""
+            else:
+                self.__raw_source = rest[1:space]
+                rest = rest[space + 1:]
+                
+        # the command runs up to the first ':', everything after it is the params
+        colon = rest.find(':')
+        if colon < 0:
+            cmd = rest
+            params = None
+        else:
+            cmd = rest[:colon]
+            params = rest[colon + 1:] or None
+            
+        if not cmd:
             print("==============================================")
             print("Failed to parse message")
             print(in_raw_message)
             print("==============================================")
         else:
-            tags = m.group("tags")
-            source = m.group("source")
-            cmd = m.group("command")
-            params = m.group("params")
-            
-            if tags:
-                self.__parse_tags(tags[1:])
-                
-            if source:
-                splitSource = source[1:].split('!')
-                self.message["source"] = dict()
-                self.message["source"]["nick"] = splitSource[0] if len(splitSource) > 1 else None
-                self.message["source"]["host"] = splitSource[1] if len(splitSource) > 1 else splitSource[0]
-
             self.__parse_command(cmd, params)
-            if self.command == "PRIVMSG":
-                m2 = re.fullmatch("^\x01ACTION (?P<message>.+)\x01$", self.content)
-                if m2:
-                    self.message["content"] = "/me " + m2.group("message")
+            if self.__command == "PRIVMSG":
+                content = self.__content
+                if content and len(content) > len(ACTION_PREFIX) + len(ACTION_SUFFIX) and content.startswith(ACTION_PREFIX) and content.endswith(ACTION_SUFFIX):
+                    self.__content = "/me " + content[len(ACTION_PREFIX):-len(ACTION_SUFFIX)]
             
     def __repr__(self):
         return str(self.message)
-            
-    def __get_property(self, prop_name):
-        return self.message[prop_name] if prop_name in self.message else None
+        
+    def get_tag(self, tag_name, default=None):
+        val = self.tags.get(tag_name)
+        return val if val is not None else default
+        
+    @property
+    def tags(self):
+        if self.__tags is None:
+            self.__tags = self.__parse_tags(self.__raw_tags) if self.__raw_tags else dict()
+        return self.__tags
+        
+    @property
+    def source(self):
+        if self.__source is None and self.__raw_source is not None:
+            splitSource = self.__raw_source.split('!')
+            self.__source = {
+                "nick": splitSource[0] if len(splitSource) > 1 else None,
+                "host": splitSource[1] if len(splitSource) > 1 else splitSource[0]
+            }
+        return self.__source
+        
+    @property
+    def message(self):
+        # everything decoded into a single dict, only meant for debugging and older code
+        out = dict()
+        for key, val in self.tags.items():
+            if key in ["badge-info", "badges", "emotes"] and val is not None:
+                continue
+            out[key] = val.split(',') if key == "emote-sets" and val is not None else val
+        if self.badges is not None:
+            out["badges"] = self.badges
+        if self.emotes is not None:
+            out["emotes"] = self.emotes
+        if self.source is not None:
+            out["source"] = self.source
+        if self.__command is not None:
+            out["command"] = self.__command
+        if self.__command in CHANNEL_COMMANDS:
+            out["channel"] = self.__channel
+        if self.__command in CHANNEL_COMMANDS or self.__command in CONTENT_COMMANDS:
+            out["content"] = self.__content
+        if self.__command == "CAP":
+            out["ack"] = self.__ack
+            out["capabilities"] = self.__capabilities
+        return out
             
     @property
     def command(self):
-        return self.__get_property("command")
+        return self.__command
             
     @property
     def name(self):
-        return self.message["source"]["nick"]
+        return self.source["nick"]
         
     @property
     def display_name(self):
-        return self.__get_property("display-name")
+        return self.get_tag("display-name")
             
     @property
     def channel(self):
-        return self.__get_property("channel")
+        return self.__channel
         
     @property
     def channel_id(self):
-        id = self.__get_property("room-id")
-        return int(id) if id else 0
+        id = self.get_tag("room-id")
+        return intern_channel_id(int(id)) if id else 0
         
     @property
     def user_id(self):
-        id = self.__get_property("user-id")
+        id = self.get_tag("user-id")
         return int(id) if id else 0
             
     @property
     def content(self):
-        return self.__get_property("content")
+        return self.__content
+        
+    @property
+    def msg_id(self):
+        return self.get_tag("msg-id")
+        
+    @property
+    def ack(self):
+        return self.__ack
+        
+    @property
+    def capabilities(self):
+        return self.__capabilities
         
     @property
     def badges(self):
-        return self.__get_property("badges")
+        if self.__badges is None:
+            self.__badges = self.__parse_badges(self.get_tag("badge-info"), self.get_tag("badges"))
+        # an empty dict means there were no badges at all
+        return self.__badges if self.__badges else None
+        
+    @property
+    def emotes(self):
+        if self.__emotes is None:
+            raw_emotes = self.get_tag("emotes")
+            self.__emotes = self.__parse_emotes(raw_emotes) if raw_emotes else dict()
+        return self.__emotes if self.__emotes else None
         
     @property
     def is_mod(self):
-        return (self.__get_property("mod") not in [None, '0']) or self.is_broadcaster
+        return (self.get_tag("mod") not in [None, '0']) or self.is_broadcaster
         
     @property
     def is_vip(self):
@@ -96,58 +202,55 @@ class IRCData():
         
     @property
     def is_subscriber(self):
-        return (self.__get_property("subscriber") not in [None, '0']) or self.is_broadcaster
+        return (self.get_tag("subscriber") not in [None, '0']) or self.is_broadcaster
             
     def __parse_command(self, command, params):
         splitCommand = command.split(' ')
         
         cmd = splitCommand[0]
-        self.message["command"] = cmd
+        self.__command = cmd
         
-        if cmd in ["JOIN", "PART", "NOTICE", "CLEARCHAT", "HOSTTARGET", "PRIVMSG", "USERSTATE", "ROOMSTATE", "001"]:
+        if cmd in CHANNEL_COMMANDS:
             if splitCommand[1][0] == '#':
                 splitCommand[1] = splitCommand[1][1:]
-            self.message["channel"] = splitCommand[1]
-            self.message["content"] = params
-        elif cmd in ["CAP"]:
-            self.message["ack"] = splitCommand[1] == "ACK"
-            self.message["capabilities"] = self.__parse_capabilities(params)
-        elif cmd in ["PING", "GLOBALUSERSTATE", "RECONNECT"]:
-            self.message["content"] = params
+            self.__channel = splitCommand[1]
+            self.__content = params
+        elif cmd == "CAP":
+            self.__ack = splitCommand[1] == "ACK"
+            self.__capabilities = self.__parse_capabilities(params)
+        elif cmd in CONTENT_COMMANDS:
+            self.__content = params
         
     def __parse_tags(self, raw_tags):
-        tags = raw_tags.split(";")
+        out_tags = dict()
         
-        for tag in tags:
-            key, val = tag.split('=', 1)
+        for tag in raw_tags.split(';'):
+            key, _, val = tag.partition('=')
+            out_tags[key] = val if val else None
             
-            if len(val) == 0:
-                val = None
+        return out_tags
+        
+    def __parse_badges(self, raw_badge_info, raw_badges):
+        out_badges = dict()
+        
+        for key, val in [("badge-info", raw_badge_info), ("badges", raw_badges)]:
+            if val is None:
+                continue
                 
-            if val is not None and key in ["badge-info", "badges"]:
-                if not "badges" in self.message:
-                    self.message["badges"] = dict()
-                    
-                badges = val.split(',')
+            for badge in val.split(','):
+                badge_name, metadata = badge.split('/', 1)
                 
-                for badge in badges:
-                    badge_name, metadata = badge.split('/', 1)
+                if not badge_name in out_badges:
+                    out_badges[badge_name] = dict()
                     
-                    if not badge_name in self.message["badges"]:
-                        self.message["badges"][badge_name] = dict()
-                        
-                    if key == "badge-info" and badge_name == "subscriber":
-                        self.message["badges"][badge_name]["months"] = metadata
-                    elif key == "badge-info" and badge_name == "predictions":
-                        self.message["badges"][badge_name]["prediction_name"] = metadata
-                    else:
-                        self.message["badges"][badge_name]["version"] = metadata
-            elif val is not None and key == "emotes":
-                self.message["emotes"] = self.__parse_emotes(val)
-            elif val is not None and key == "emote-sets":
-                self.message["emote-sets"] = val.split(',')
-            else:
-                self.message[key] = val
+                if key == "badge-info" and badge_name == "subscriber":
+                    out_badges[badge_name]["months"] = metadata
+                elif key == "badge-info" and badge_name == "predictions":
+                    out_badges[badge_name]["prediction_name"] = metadata
+                else:
+                    out_badges[badge_name]["version"] = metadata
+                    
+        return out_badges
                 
     def __parse_emotes(self, raw_emotes):
         emotes = raw_emotes.split('/')
@@ -191,9 +294,9 @@ class IRCPackets():
                 if message[0:3] == '/me':
                     message = '\x01ACTION ' + message[3:] + '\x01'
                 else:
-                    message = re.sub("^(/\s*)+", "", message)
+                    message = SLASH_PREFIX_PATTERN.sub("", message)
             if message[0] == '.':
-                message = re.sub("^(\.\s*)+", "", message)
+                message = DOT_PREFIX_PATTERN.sub("", message)
             reply = f"@reply-parent-msg-id={reply_id}" if reply_id else ""
             self.__packet = f"{reply} PRIVMSG #{channel.name} :{message}".strip()
             
@@ -215,6 +318,7 @@ class IRCPackets():
         
     class Join(Packet):
         def __init__(self, channel):
+            self.__channel = channel
             self.__packet = f"JOIN #{channel}"
             
         def __lt__(self, other):
@@ -226,11 +330,16 @@ class IRCPackets():
         def get(self):
             return self.__packet
             
+        @property
+        def channel(self):
+            return self.__channel
+            
         def queue_type(self):
             return IRCPackets.QueueType.JOIN
         
     class Part(Packet):
         def __init__(self, channel):
+            self.__channel = channel
             self.__packet = f"PART #{channel}"
             
         def __lt__(self, other):
@@ -242,6 +351,10 @@ class IRCPackets():
         def get(self):
             return self.__packet
             
+        @property
+        def channel(self):
+            return self.__channel
+            
         def queue_type(self):
             return IRCPackets.QueueType.PART
         
@@ -281,16 +394,16 @@ class TwitchMessage():
         self.__channel = in_channel
         self.__user = in_user
         self.__badge_data = in_irc_data.badges
-        self.__color = in_irc_data.message["color"]
-        self.__content = in_irc_data.message["content"]
-        self.__emote_data = in_irc_data.message["emotes"]
-        self.__first_msg = in_irc_data.message["first-msg"] if "first-msg" in in_irc_data.message else '0'
-        self.__message_id = in_irc_data.message["id"]
-        self.__mod = in_irc_data.message["mod"]
-        self.__returning_chatter = in_irc_data.message["returning-chatter"] if "returning-chatter" in in_irc_data.message else '0'
-        self.__time_sent = in_irc_data.message["tmi-sent-ts"]
-        self.__turbo = in_irc_data.message["turbo"]
-        self.__user_type = in_irc_data.message["user-type"]
+        self.__color = in_irc_data.get_tag("color")
+        self.__content = in_irc_data.content
+        self.__emote_data = in_irc_data.emotes
+        self.__first_msg = in_irc_data.get_tag("first-msg", '0')
+        self.__message_id = in_irc_data.get_tag("id")
+        self.__mod = in_irc_data.get_tag("mod")
+        self.__returning_chatter = in_irc_data.get_tag("returning-chatter", '0')
+        self.__time_sent = in_irc_data.get_tag("tmi-sent-ts")
+        self.__turbo = in_irc_data.get_tag("turbo")
+        self.__user_type = in_irc_data.get_tag("user-type")
         self.__reply_callback = in_reply_callback
         
     def __repr__(self):
@@ -360,4 +473,4 @@ class TwitchMessage():
         
 class TwitchChannel():
     def __init__(self, in_irc_data):
-        self.__channel = in_irc_data.message["channel"]
\ No newline at end of file
+        self.__channel = in_irc_data.channel
\ No newline at end of file
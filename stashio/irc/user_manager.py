@@ -1,49 +1,80 @@
+from stashio.utils.data import TTLCache
+
 class UserRoles():
-    def __init__(self, in_privmsg_packet):
-        self.update_roles(in_privmsg_packet)
-        
-    def __repr__(self):
-        return str({"Mod": self.__is_mod, "VIP": self.__is_vip, "Sub": self.__is_subscriber, "Broadcaster": self.__is_broadcaster})
-        
-    def update_roles(self, in_privmsg_packet):
-        self.__is_mod = in_privmsg_packet.is_mod
-        self.__is_vip = in_privmsg_packet.is_vip
-        self.__is_subscriber = in_privmsg_packet.is_vip
-        self.__is_broadcaster = in_privmsg_packet.is_broadcaster
-        
-    @property
-    def is_mod(self):
-        return self.__is_mod
-        
-    @property
-    def is_vip(self):
-        return self.__is_vip
-        
-    @property
-    def is_subscriber(self):
-        return self.__is_subscriber
-        
-    @property
-    def is_broadcaster(self):
-        return self.__is_broadcaster
+    # a user's roles in one channel are packed into an int with these bits
+    MOD = 1
+    VIP = 2
+    SUBSCRIBER = 4
+    BROADCASTER = 8
+    
+    @staticmethod
+    def from_packet(in_privmsg_packet):
+        roles = 0
+        if in_privmsg_packet.is_mod:
+            roles |= UserRoles.MOD
+        if in_privmsg_packet.is_vip:
+            roles |= UserRoles.VIP
+        if in_privmsg_packet.is_subscriber:
+            roles |= UserRoles.SUBSCRIBER
+        if in_privmsg_packet.is_broadcaster:
+            roles |= UserRoles.BROADCASTER
+        return roles
+        
+    @staticmethod
+    def to_dict(in_roles):
+        return {"Mod": bool(in_roles & UserRoles.MOD), "VIP": bool(in_roles & UserRoles.VIP), "Sub": bool(in_roles & UserRoles.SUBSCRIBER), "Broadcaster": bool(in_roles & UserRoles.BROADCASTER)}
 
 class User():
+    # there can be millions of these, so no __dict__ per user
+    __slots__ = ("__channel_id", "__roles", "__other_roles", "__name", "__display_name", "__user_id")
+    
     def __init__(self, in_privmsg_packet):
-        self.__role_cache = dict()
+        # most chatters only ever talk in one channel, so its roles are stored inline
+        self.__channel_id = None
+        self.__roles = 0
+        # channel id -> roles for every other channel, only created once they talk somewhere else
+        self.__other_roles = None
         self.__name = in_privmsg_packet.name
-        self.__display_name = in_privmsg_packet.display_name
+        display_name = in_privmsg_packet.display_name
+        # share the string when they're the same
+        self.__display_name = display_name if display_name != self.__name else self.__name
         self.__user_id = in_privmsg_packet.user_id
         self.update_user_data(in_privmsg_packet)
         
     def __repr__(self):
-        return str({"Role": str(self.__role_cache), "Name": self.__name, "Display Name": self.__display_name, "User ID": self.__user_id})
+        roles = {channel_id: UserRoles.to_dict(self.get_roles(channel_id)) for channel_id in self.channel_ids}
+        return str({"Role": str(roles), "Name": self.__name, "Display Name": self.__display_name, "User ID": self.__user_id})
+        
+    def rename(self, in_privmsg_packet):
+        self.__name = in_privmsg_packet.name
+        display_name = in_privmsg_packet.display_name
+        self.__display_name = display_name if display_name != self.__name else self.__name
         
     def update_user_data(self, in_privmsg_packet):
         current_channel_id = in_privmsg_packet.channel_id
-        if not current_channel_id in self.__role_cache:
-            self.__role_cache[current_channel_id] = UserRoles(in_privmsg_packet)
-        
-        self.__role_cache[current_channel_id].update_roles(in_privmsg_packet)
+        roles = UserRoles.from_packet(in_privmsg_packet)
+        if self.__channel_id is None or self.__channel_id == current_channel_id:
+            self.__channel_id = current_channel_id
+            self.__roles = roles
+        else:
+            if self.__other_roles is None:
+                self.__other_roles = dict()
+            self.__other_roles[current_channel_id] = roles
+            
+    @property
+    def channel_ids(self):
+        ids = [self.__channel_id] if self.__channel_id is not None else []
+        if self.__other_roles:
+            ids += list(self.__other_roles.keys())
+        return ids
+        
+    # Returns the UserRoles bits for channel_id, 0 if we haven't seen them talk there
+    def get_roles(self, channel_id):
+        if channel_id == self.__channel_id:
+            return self.__roles
+        if self.__other_roles:
+            return self.__other_roles.get(channel_id, 0)
+        return 0
 
     @property
     def name(self):
@@ -53,48 +84,68 @@ class User():
     def display_name(self):
         return self.__display_name
         
-    @property
     def is_mod(self, channel_id):
-        return channel_id in self.__role_cache and self.__role_cache[channel_id].is_mod
+        return bool(self.get_roles(channel_id) & UserRoles.MOD)
         
-    @property
     def is_subscriber(self, channel_id):
-        return channel_id in self.__role_cache and self.__role_cache[channel_id].is_subscriber
+        return bool(self.get_roles(channel_id) & UserRoles.SUBSCRIBER)
         
-    @property
     def is_vip(self, channel_id):
-        return channel_id in self.__role_cache and self.__role_cache[channel_id].is_vip
+        return bool(self.get_roles(channel_id) & UserRoles.VIP)
         
-    @property
     def is_broadcaster(self, channel_id):
-        return channel_id in self.__role_cache and self.__role_cache[channel_id].is_broadcaster
+        return bool(self.get_roles(channel_id) & UserRoles.BROADCASTER)
 
     @property
     def channel_id(self):
         return self.__user_id
 
 class UserManager():
-    def __init__(self):
-        self.__user_cache = dict()
+    def __init__(self, in_max_users=500000, in_idle_ttl=6*60*60):
+        # user id -> User, the least recently active go first once we're full or they've been quiet too long
+        self.__user_cache = TTLCache(in_max_users, in_idle_ttl, in_refresh_on_access=True, in_on_evict=self.__on_user_evicted)
+        # login -> user id, only for users that are still in the user cache
         self.__user_name_to_id = dict()
         
     def __repr__(self):
-        return str(self.__user_cache)
+        return str(dict(self.__user_cache.items()))
+        
+    def get_cache_stats(self):
+        stats = self.__user_cache.get_stats()
+        stats["names"] = len(self.__user_name_to_id)
+        return stats
+        
+    def __on_user_evicted(self, in_user_id, in_user):
+        # the login might belong to someone else by now
+        if self.__user_name_to_id.get(in_user.name) == in_user_id:
+            del self.__user_name_to_id[in_user.name]
         
     def __add_or_find_user(self, in_privmsg_data):
         user_id = in_privmsg_data.user_id
-        if not user_id in self.__user_cache:
-            self.__user_cache[user_id] = User(in_privmsg_data)
-            assert(in_privmsg_data.name not in self.__user_name_to_id)
-            self.__user_name_to_id[in_privmsg_data.name] = user_id
-        return self.__user_cache[user_id]
-        
+        user = self.__user_cache.get(user_id)
+        if user is None:
+            user = User(in_privmsg_data)
+            self.__user_cache.set(user_id, user)
+        elif user.name != in_privmsg_data.name:
+            # they renamed, the old login is free for someone else now
+            if self.__user_name_to_id.get(user.name) == user_id:
+                del self.__user_name_to_id[user.name]
+            user.rename(in_privmsg_data)
+            
+        # a login that comes back under a new id was given up by whoever had it before
+        self.__user_name_to_id[in_privmsg_data.name] = user_id
+        return user
+        
+    # Returns the user the message came from
     async def set_user_data(self, in_privmsg_data):
+        # idle users are at the front, so this only looks at ones that are actually expired
+        self.__user_cache.prune()
         user = self.__add_or_find_user(in_privmsg_data)
         user.update_user_data(in_privmsg_data)
+        return user
         
     async def get_user(self, in_user_id):
-        return self.__user_cache[in_user_id] if in_user_id in self.__user_cache else None
+        return self.__user_cache.get(in_user_id)
         
     def get_channel_id_from_name(self, in_user_name):
-        return self.__user_name_to_id[in_user_name] if in_user_name in self.__user_name_to_id else None
\ No newline at end of file
+        return self.__user_name_to_id.get(in_user_name)
@@ -1,16 +1,75 @@
 import aiohttp
 import asyncio
+import time
 import ujson
 from stashio.utils.auth import Auth
+from stashio.utils.singleflight import SingleFlight
+from stashio.utils.data import TTLCache
+from stashio.twitch.rate_limiter import HelixRateLimiter, RequestPriority
+
+# marks a cache lookup that found nothing, since None is a valid cached value
+CACHE_MISS = object()
+
+class TwitchApiError(Exception):
+    def __init__(self, in_status, in_message, in_retry_after=None, in_no_response=False):
+        super().__init__(f"{in_status}: {in_message}")
+        self.__status = in_status
+        self.__message = in_message
+        self.__retry_after = in_retry_after
+        # the request timed out or the connection failed, so twitch never answered
+        self.__no_response = in_no_response
+        
+    @property
+    def status(self):
+        return self.__status
+        
+    @property
+    def message(self):
+        return self.__message
+        
+    # seconds twitch wants us to wait before trying again, if it told us
+    @property
+    def retry_after(self):
+        return self.__retry_after
+        
+    @property
+    def no_response(self):
+        return self.__no_response
+        
+    # 401 is retryable because we refresh the token before raising it
+    @property
+    def is_retryable(self):
+        return self.__no_response or self.__status in [401, 429] or self.__status >= 500
 
 class TwitchApi():
-    def __init__(self, in_auth: Auth):
+    # seconds each cached endpoint stays valid unless something tells us it changed
+    DEFAULT_CACHE_TTLS = {
+        "chat_settings": 60,
+        "channel_information": 120,
+        "streams": 30
+    }
+    
+    def __init__(self, in_auth: Auth, in_http=None, in_cache_ttls=None, in_cache_size=1000, in_rate_limiter=None, in_max_rate_limited_attempts=3):
         self.__auth = in_auth
+        # pooled keep-alive connections to helix, shared with auth by default
+        self.__http = in_http if in_http else in_auth.http
+        # identical GETs that are running at the same time share one request
+        self.__single_flight = SingleFlight()
+        # keeps us inside the helix points bucket, with chat handlers ahead of background work
+        self.__rate_limiter = in_rate_limiter if in_rate_limiter else HelixRateLimiter()
+        # how many times a request goes back in line after a 429 before we give up on it
+        self.__max_rate_limited_attempts = in_max_rate_limited_attempts
+        # endpoint -> cache of its responses, keyed by broadcaster id (or login for streams)
+        ttls = dict(TwitchApi.DEFAULT_CACHE_TTLS)
+        if in_cache_ttls:
+            ttls.update(in_cache_ttls)
+        self.__caches = {name: TTLCache(in_cache_size, ttl) for name, ttl in ttls.items()}
         
-    def __get_oauth_header(self, content_type=None):
+    async def __get_oauth_header(self, content_type=None):
+        # waits out a refresh that's running or due instead of sending a token we know is bad
         out = {
             'client-id': self.__auth.get_client_id(),
-            'authorization': f'Bearer {self.__auth.get_access_token()}'
+            'authorization': f'Bearer {await self.__auth.get_valid_access_token()}'
         }
         
         if content_type:
@@ -18,18 +77,95 @@ class TwitchApi():
             
         return out
         
-    async def __api_request(self, session, url):
-        async with session.get(url) as r:
-            return await r.json()
+    async def __api_request(self, url, priority=RequestPriority.INTERACTIVE):
+        return await self.__single_flight.do(("GET", url), lambda: self.__api_request_get(url, priority))
+        
+    async def __api_request_get(self, url, priority):
+        session = await self.__http.get()
+        for attempt in range(self.__max_rate_limited_attempts):
+            await self.__rate_limiter.acquire(priority)
+            headers = None
+            try:
+                async with session.get(url, headers=await self.__get_oauth_header()) as r:
+                    headers = r.headers
+                    if r.status == 429 and attempt + 1 < self.__max_rate_limited_attempts:
+                        self.__rate_limiter.on_rate_limited(headers)
+                        continue
+                    return await r.json()
+            finally:
+                self.__rate_limiter.release(headers)
             
-    async def __api_request_post_json(self, session, url, data):
-        async with session.post(url, json=data) as r:
-            return await r.json()
+    async def __api_request_post_json(self, url, data, priority):
+        session = await self.__http.get()
+        await self.__rate_limiter.acquire(priority)
+        headers = None
+        try:
+            async with session.post(url, json=data, headers=await self.__get_oauth_header(content_type="application/json")) as r:
+                headers = r.headers
+                if r.status == 429:
+                    self.__rate_limiter.on_rate_limited(headers)
+                # gateway errors come back as html, so the body is only json if it parses as json
+                text = await r.text()
+                try:
+                    result = ujson.loads(text) if text else None
+                except ValueError:
+                    result = None
+                return r.status, r.headers, result if isinstance(result, dict) else None
+        finally:
+            self.__rate_limiter.release(headers)
             
+    def __get_retry_after(self, headers):
+        # helix tells us when the bucket refills as a unix timestamp
+        reset = headers.get('Ratelimit-Reset')
+        if reset:
+            try:
+                return max(int(reset) - time.time(), 0)
+            except ValueError:
+                pass
+        retry_after = headers.get('Retry-After')
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return None
+            
+    def get_cache_stats(self):
+        return {name: cache.get_stats() for name, cache in self.__caches.items()}
+        
+    def invalidate_channel_settings(self, channel_id):
+        self.__caches["chat_settings"].invalidate(str(channel_id))
+        
+    def invalidate_channel_information(self, channel_id):
+        self.__caches["channel_information"].invalidate(str(channel_id))
+        
+    def invalidate_stream(self, channel_name):
+        self.__caches["streams"].invalidate(channel_name.lower())
+        
+    async def __cached_request(self, cache_name, key, url):
+        cache = self.__caches[cache_name]
+        result = cache.get(key, CACHE_MISS)
+        if result is not CACHE_MISS:
+            return result
+            
+        result = await self.ExecuteTwitchAPIRequest(url)
+        if result is not None:
+            cache.set(key, result)
+        return result
+        
+    def get_rate_limit_stats(self):
+        return self.__rate_limiter.get_stats()
+        
+    def get_single_flight_stats(self):
+        return self.__single_flight.get_stats()
+        
+    async def close(self):
+        await self.__http.close()
+        
     async def RefreshIRCAccessToken(self):
         await self.__auth.refresh_irc_access_token()
         
-    async def GetUsers(self, users=None, ids=None):
+    async def GetUsers(self, users=None, ids=None, priority=RequestPriority.INTERACTIVE):
         requests = []
         if users:
             requests = [f'login={user}' for user in users]
@@ -41,32 +177,118 @@ class TwitchApi():
         for i in range(0, len(requests), 100):
             fetch_requests.append(f'https://api.twitch.tv/helix/users?{"&".join(requests[i:i+100])}')
 
-        async with aiohttp.ClientSession(headers=self.__get_oauth_header()) as session:
-            results = await asyncio.gather(*[self.__api_request(session, url) for url in fetch_requests], return_exceptions=True)
-            return results
+        results = await asyncio.gather(*[self.__api_request(url, priority) for url in fetch_requests], return_exceptions=True)
+        return results
             
-    async def ExecuteTwitchAPIRequest(self, url, all_results=False, data_only=True):
+    # Like ExecuteTwitchAPIRequest but raises TwitchApiError instead of returning None
+    async def __execute_request(self, url, priority=RequestPriority.INTERACTIVE):
         refresh=2
         while refresh > 0:
             refresh = refresh - 1
-            async with aiohttp.ClientSession(headers=self.__get_oauth_header()) as session:
-                result = await self.__api_request(session, url)
-                
-                if 'error' in result:
-                    if result['status'] == 401:
-                        await self.__auth.refresh_access_token()
-                        continue
-                elif not 'data' in result:
-                    print("BAD RESULT DURING API REQUEST:",result)
-                    return None
+            token = self.__auth.get_access_token()
+            result = await self.__api_request(url, priority)
+            
+            if 'error' in result:
+                if result['status'] == 401 and refresh > 0:
+                    # only refreshes if nobody else already did since we sent the request
+                    await self.__auth.refresh_access_token(token)
+                    continue
+                raise TwitchApiError(result['status'], result.get('message'))
+            elif not 'data' in result:
+                raise TwitchApiError(result.get('status', 0), f"Bad result during api request: {result}")
+            return result
+            
+    async def ExecuteTwitchAPIRequest(self, url, all_results=False, data_only=True, priority=RequestPriority.INTERACTIVE):
+        try:
+            result = await self.__execute_request(url, priority)
+        except TwitchApiError as e:
+            print("BAD RESULT DURING API REQUEST:",e)
+            return None
+            
+        if data_only:
+            if len(result['data']) == 0 or all_results:
+                return result['data']
+            else:
+                return result['data'][0]
+        else:
+            return result
                     
-                if data_only:
-                    if len(result['data']) == 0 or all_results:
-                        return result['data']
-                    else:
-                        return result['data'][0]
+    def __add_query(self, url, query):
+        return f'{url}{"&" if "?" in url else "?"}{query}'
+        
+    # Yields every item from every page, following pagination.cursor until twitch runs out.
+    # Raises TwitchApiError if a page fails, after yielding everything from the pages before it.
+    async def PaginateTwitchAPIRequest(self, url, page_size=100, priority=RequestPriority.INTERACTIVE):
+        cursor = None
+        while True:
+            page_url = self.__add_query(url, f'first={page_size}')
+            if cursor:
+                page_url = self.__add_query(page_url, f'after={cursor}')
+                
+            result = await self.__execute_request(page_url, priority)
+            for item in result['data']:
+                yield item
+                
+            cursor = result.get('pagination', dict()).get('cursor')
+            if not cursor or len(result['data']) == 0:
+                return
+                
+    # Splits values into requests of up to 100 that run side by side, and yields items as any of them get them.
+    # The buffer is bounded so a slow consumer holds back the requests instead of piling up results.
+    # If any chunk fails the first error is raised once the other chunks are finished.
+    async def PaginateChunkedTwitchAPIRequest(self, url, param, values, chunk_size=100, max_concurrent=4, buffer_size=500, priority=RequestPriority.INTERACTIVE):
+        chunks = [values[i:i+chunk_size] for i in range(0, len(values), chunk_size)]
+        if len(chunks) == 0:
+            return
+            
+        items = asyncio.Queue(maxsize=buffer_size)
+        # marks a chunk that has nothing left to give
+        done = object()
+        limit = asyncio.Semaphore(max_concurrent)
+        errors = []
+        
+        async def fetch_chunk(chunk):
+            try:
+                async with limit:
+                    chunk_url = self.__add_query(url, "&".join(f'{param}={value}' for value in chunk))
+                    async for item in self.PaginateTwitchAPIRequest(chunk_url, page_size=chunk_size, priority=priority):
+                        await items.put(item)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                errors.append(e)
+            await items.put(done)
+                
+        tasks = [asyncio.ensure_future(fetch_chunk(chunk)) for chunk in chunks]
+        try:
+            remaining = len(tasks)
+            while remaining > 0:
+                item = await items.get()
+                if item is done:
+                    remaining -= 1
                 else:
-                    return result
+                    yield item
+                    
+            if len(errors) > 0:
+                raise errors[0]
+        finally:
+            # the caller stopped early, nobody is going to read the rest
+            for task in tasks:
+                task.cancel()
+                
+    async def IterateStreams(self, channel_names=None, user_ids=None, priority=RequestPriority.INTERACTIVE):
+        if channel_names:
+            async for stream in self.PaginateChunkedTwitchAPIRequest('https://api.twitch.tv/helix/streams?type=all', 'user_login', list(channel_names), priority=priority):
+                yield stream
+        if user_ids:
+            async for stream in self.PaginateChunkedTwitchAPIRequest('https://api.twitch.tv/helix/streams?type=all', 'user_id', list(user_ids), priority=priority):
+                yield stream
+                
+    async def IterateFollowers(self, in_user, priority=RequestPriority.BULK):
+        channel_id = await self.GetChannelID(in_user)
+        if channel_id:
+            async for follower in self.PaginateTwitchAPIRequest(f'https://api.twitch.tv/helix/channels/followers?broadcaster_id={channel_id}', priority=priority):
+                yield follower
                     
     async def GetFollowerCount(self, in_user):
         channel_id = await self.GetChannelID(in_user)
@@ -82,20 +304,56 @@ class TwitchApi():
     
     async def GetChannelSettings(self, channel_id):
         url = f'https://api.twitch.tv/helix/chat/settings?broadcaster_id={channel_id}'
-        return await self.ExecuteTwitchAPIRequest(url)
+        return await self.__cached_request("chat_settings", str(channel_id), url)
             
     async def GetChannelInformation(self, channel_id):
         url = f'https://api.twitch.tv/helix/channels?broadcaster_id={channel_id}'
-        return await self.ExecuteTwitchAPIRequest(url)
+        return await self.__cached_request("channel_information", str(channel_id), url)
             
     async def GetStreamsInfo(self, channel_names):
-        channel_names_string = "&user_login=".join(channel_names)
-        url = f'https://api.twitch.tv/helix/streams?type=all&first=100&user_login={channel_names_string}'
-        return await self.ExecuteTwitchAPIRequest(url, all_results=True)
+        cache = self.__caches["streams"]
+        names = [name.lower() for name in channel_names]
+        # login -> stream data, or None if they're offline
+        streams = dict()
+        missing = []
+        for name in names:
+            stream = cache.get(name, CACHE_MISS)
+            if stream is CACHE_MISS:
+                missing.append(name)
+            else:
+                streams[name] = stream
+                
+        if len(missing) > 0:
+            for name in missing:
+                streams[name] = None
+            try:
+                async for stream in self.IterateStreams(channel_names=missing):
+                    streams[stream['user_login']] = stream
+            except TwitchApiError as e:
+                print("BAD RESULT DURING API REQUEST:",e)
+                return None
+                
+            for name in missing:
+                cache.set(name, streams[name])
+                
+        return [streams[name] for name in names if streams.get(name) is not None]
 
-    async def EventSub_CreateSubscription(self, in_data):
-        async with aiohttp.ClientSession(headers=self.__get_oauth_header(content_type="application/json")) as session:
-            url = 'https://api.twitch.tv/helix/eventsub/subscriptions'
-            result = await self.__api_request_post_json(session, url, data=in_data)
-            return result["data"][0]
-            
\ No newline at end of file
+    # Subscriptions tend to get created by the hundred, so they go in the bulk lane by default
+    async def EventSub_CreateSubscription(self, in_data, priority=RequestPriority.BULK):
+        url = 'https://api.twitch.tv/helix/eventsub/subscriptions'
+        token = self.__auth.get_access_token()
+        try:
+            status, headers, result = await self.__api_request_post_json(url, data=in_data, priority=priority)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # might have been a blip, worth another try
+            raise TwitchApiError(0, f"No response: {e!r}", in_no_response=True)
+        
+        if status == 401:
+            await self.__auth.refresh_access_token(token)
+            # worth retrying right away with the new token
+            raise TwitchApiError(status, result.get("message") if result else None, 0)
+        if status >= 400:
+            raise TwitchApiError(status, result.get("message") if result else None, self.__get_retry_after(headers))
+        if not result or not result.get("data"):
+            raise TwitchApiError(status, f"Bad result creating subscription: {result}")
+        return result["data"][0]
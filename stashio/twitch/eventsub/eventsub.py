@@ -1,38 +1,100 @@
 import asyncio
+import random
+import time
+import traceback
 import ujson
 import stashio.twitch.eventsub.types as EventSubTypes
-from stashio.utils.auth import Auth
-from stashio.utils.data import DelayQueue
 from stashio.connection.wss_connection import BaseConnection
+from stashio.utils.dispatch import DispatchPool
+from stashio.twitch.api import TwitchApiError
+from stashio.utils.data import TimingStats
 
 class EventSubConnection(BaseConnection):
-    def __init__(self, in_twitch_api, in_server='wss://eventsub.wss.twitch.tv/ws'):
-        super().__init__(in_server)
+    def __init__(self, in_twitch_api, in_server='wss://eventsub.wss.twitch.tv/ws', in_on_session_lost=None, in_dispatch_workers=8, in_dispatch_queue_depth=256,
+                 in_max_concurrent_requests=10, in_max_request_attempts=5, in_archive=None):
+        # each eventsub frame is exactly one json message
+        super().__init__(in_server, in_delimiter=None)
         # asyncio event loop
         self.__loop = asyncio.get_event_loop()
-        # the current subscribed subscriptions
+        # (type, version, broadcaster, reward) -> callbacks for that subscription
         self.__subscriptions = dict()
-        # pending api requests waiting to be processed by the pending api task
-        self.__pending_api_requests = []
+        # (type, version, broadcaster, reward) -> the subscription object behind it, so it can be moved or re-created
+        self.__subscription_objects = dict()
+        # runs callbacks, one event at a time per broadcaster
+        self.__dispatch = DispatchPool(self.__dispatch_event, in_dispatch_workers, in_dispatch_queue_depth)
+        # called with (connection, [(subscription, callback, creation future)]) when the session drops, otherwise we re-create them ourselves
+        self.__on_session_lost = in_on_session_lost
+        # (key, generation) of subscriptions that still need to be created on the current session
+        self.__pending_api_requests = asyncio.Queue()
+        # key -> how many times it has been queued, so stale attempts from an old session get ignored
+        self.__generations = dict()
+        # key -> future that resolves to whether the subscription got created
+        self.__creation_futures = dict()
+        # how many subscriptions we create at once, and how many times we try each one
+        self.__max_concurrent_requests = in_max_concurrent_requests
+        self.__max_request_attempts = in_max_request_attempts
+        # set while we have a session id that subscriptions can be created on
+        self.__session_ready = asyncio.Event()
         # used to make api requests to twitch
         self.__twitch_api = in_twitch_api
         # our session that holds our session id
         self.__session = None
-        # our running event for handling api requests
-        self.__api_event = None
+        # our running tasks for handling api requests
+        self.__api_workers = []
+        # forces a reconnect when twitch goes quiet for longer than the keepalive timeout
+        self.__watchdog = None
+        # monotonic times for the dead socket or migration we're recovering from
+        self.__dead_detected_at = None
+        self.__migration_started_at = None
+        # last frame -> noticing the socket is dead, noticing -> new session, session_reconnect -> new session
+        self.__detect_times = TimingStats()
+        self.__recover_times = TimingStats()
+        self.__migrate_times = TimingStats()
+        self.__revocations = 0
+        # raw notification frames get copied here for moderation review
+        self.__archive = in_archive
+        # nothing to connect for until someone subscribes
+        self.set_connection_allowed(False)
     
     #############################################################
     ## Start BaseConnection overrides
     #############################################################
-    async def is_connection_allowed(self):
-        return len(self.__subscriptions) > 0
-        
     async def on_run(self):
-        # task to execute api requests
-        self.__api_event = self.__loop.create_task(self.process_api_requests())
+        # a restart after a crash would otherwise leave the old workers running
+        for worker in self.__api_workers:
+            worker.cancel()
+        if self.__watchdog:
+            self.__watchdog.cancel()
+        # tasks to execute api requests
+        self.__api_workers = [self.__loop.create_task(self.process_api_requests()) for _ in range(self.__max_concurrent_requests)]
+        self.__watchdog = self.__loop.create_task(self.__keepalive_watchdog())
+        self.__dispatch.start()
         
     async def on_stop(self):
-        self.__api_event.cancel()
+        for worker in self.__api_workers:
+            worker.cancel()
+        self.__api_workers = []
+        if self.__watchdog:
+            self.__watchdog.cancel()
+            self.__watchdog = None
+        self.__dispatch.stop()
+        
+    async def on_disconnect(self):
+        # twitch deletes every subscription on a session when the socket goes away
+        self.__session = None
+        self.__session_ready.clear()
+        if await self.shutdown_requested():
+            return
+            
+        if self.__on_session_lost:
+            # the pool times the recovery, since the subscriptions are going to another session
+            self.__dead_detected_at = None
+            lost = self.take_subscriptions()
+            if len(lost) > 0:
+                await self.__on_session_lost(self, lost)
+        else:
+            for key in self.__subscription_objects:
+                self.__queue_creation(key)
         
     async def on_receive(self, data):
         json_data = ujson.loads(data)
@@ -42,40 +104,200 @@ class EventSubConnection(BaseConnection):
             payload = json_data["payload"]
             if message_type == "session_welcome":
                 self.__session = EventSubTypes.Message_SessionWelcome(payload)
+                self.__session_ready.set()
+                now = time.monotonic()
+                if self.__migration_started_at is not None:
+                    self.__migrate_times.add(now - self.__migration_started_at)
+                    self.__migration_started_at = None
+                if self.__dead_detected_at is not None:
+                    self.__recover_times.add(now - self.__dead_detected_at)
+                    self.__dead_detected_at = None
             elif message_type == "notification":
                 subscription = payload["subscription"]
                 event = payload["event"]
-                await self.__subscriptions[subscription["type"]](event)
+                self.__invalidate_api_cache(subscription["type"], event)
+                key = EventSubTypes.make_subscription_key(subscription["type"], subscription["version"], subscription.get("condition"))
+                if self.__archive:
+                    self.__archive.write("eventsub", key[2], data)
+                callbacks = self.__subscriptions.get(key)
+                if callbacks:
+                    # keeps events for the same broadcaster in order while other broadcasters run alongside
+                    await self.__dispatch.submit(key[2], (callbacks, event))
+                else:
+                    print("No callbacks for subscription:",key)
             elif message_type == "session_keepalive":
+                # the watchdog only cares that the socket gave us something
                 pass
+            elif message_type == "session_reconnect":
+                # twitch is moving us, the subscriptions come along as long as we connect before the old socket closes
+                reconnect = EventSubTypes.Message_SessionWelcome(payload)
+                self.__migration_started_at = time.monotonic()
+                self.__loop.create_task(self.migrate(reconnect.reconnect_url))
+            elif message_type == "revocation":
+                subscription = payload["subscription"]
+                key = EventSubTypes.make_subscription_key(subscription["type"], subscription["version"], subscription.get("condition"))
+                print(f"Subscription {key} was revoked: {subscription.get('status')}")
+                self.__revocations += 1
+                self.__remove_subscription(key)
             else:
                 print("Unknown:",json_data)
     #############################################################
     ## End BaseConnection overrides
     #############################################################
     
+    # Returns a future that resolves to whether twitch accepted the subscription
     async def eventsub_listen(self, obj, callback):
-        if obj.type in self.__subscriptions:
-            print("Already subscribed to this event")
-            return False
+        key = obj.key
+        if key in self.__subscriptions:
+            # twitch already sends us this one, just hand it to another callback
+            self.__subscriptions[key].append(callback)
+            return self.__creation_futures[key]
             
-        self.__subscriptions[obj.type] = callback
-        await self.add_subscription(obj, callback)
-        return True
+        self.__subscriptions[key] = [callback]
+        self.__subscription_objects[key] = obj
+        self.set_connection_allowed(True)
+        return await self.add_subscription(obj, callback)
         
+    def get_stats(self):
+        return {
+            "subscriptions": len(self.__subscription_objects),
+            "detect_dead_socket": self.__detect_times.get_stats(),
+            "recover_dead_socket": self.__recover_times.get_stats(),
+            "migrate": self.__migrate_times.get_stats(),
+            "revocations": self.__revocations
+        }
+        
+    @property
+    def subscription_count(self):
+        return len(self.__subscription_objects)
+        
+    def has_subscription(self, in_key):
+        return in_key in self.__subscriptions
+        
+    # Removes every subscription from this session and returns them as [(subscription, callback, creation future)]
+    def take_subscriptions(self):
+        taken = []
+        for key, callbacks in self.__subscriptions.items():
+            obj = self.__subscription_objects[key]
+            future = self.__creation_futures.get(key)
+            taken += [(obj, callbacks[i], future if i == 0 else None) for i in range(len(callbacks))]
+        self.__subscription_objects = dict()
+        self.__subscriptions = dict()
+        self.__creation_futures = dict()
+        self.__generations = dict()
+        self.set_connection_allowed(False)
+        return taken
+        
+    def __remove_subscription(self, in_key):
+        self.__subscriptions.pop(in_key, None)
+        self.__subscription_objects.pop(in_key, None)
+        self.__generations.pop(in_key, None)
+        future = self.__creation_futures.pop(in_key, None)
+        if future and not future.done():
+            future.set_result(False)
+        if len(self.__subscriptions) == 0:
+            self.set_connection_allowed(False)
+            
+    async def __keepalive_watchdog(self):
+        while not await self.shutdown_requested():
+            await self.__session_ready.wait()
+            session = self.__session
+            last_receive = self.last_receive_time
+            if session is None or session.keepalive_timeout is None or last_receive is None:
+                await asyncio.sleep(1)
+                continue
+                
+            # twitch sends something at least every keepalive timeout, so silence past it means the socket is dead
+            remaining = last_receive + session.keepalive_timeout - time.monotonic()
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+                continue
+                
+            now = time.monotonic()
+            print(f"No eventsub message for {now - last_receive:.1f}s, reconnecting")
+            self.__detect_times.add(now - last_receive)
+            self.__dead_detected_at = now
+            # don't fire again before the disconnect gets handled
+            self.__session_ready.clear()
+            await self.force_reconnect()
+            
+    def __invalidate_api_cache(self, in_type, in_event):
+        # drop cached helix responses that this notification tells us are stale
+        if in_type == "channel.update":
+            self.__twitch_api.invalidate_channel_information(in_event["broadcaster_user_id"])
+        elif in_type == "channel.chat_settings.update":
+            self.__twitch_api.invalidate_channel_settings(in_event["broadcaster_user_id"])
+        elif in_type in ["stream.online", "stream.offline"]:
+            self.__twitch_api.invalidate_stream(in_event["broadcaster_user_login"])
+        
+    async def __dispatch_event(self, in_item):
+        callbacks, event = in_item
+        if len(callbacks) == 1:
+            await callbacks[0](event)
+            return
+            
+        results = await asyncio.gather(*[callback(event) for callback in callbacks], return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                print("Exception in eventsub callback:", repr(result))
+        
+    # Returns a future per subscription, see eventsub_listen
     async def channel_subscribe(self, channel_id, subscriptions_and_callbacks):
+        futures = []
         for sub, callback in subscriptions_and_callbacks:
             obj = sub(channel_id)
-            await self.eventsub_listen(obj, callback)
+            futures.append(await self.eventsub_listen(obj, callback))
+        return futures
         
     async def add_subscription(self, subscription_obj, callback):
-        self.__pending_api_requests.append(subscription_obj)
+        return self.__queue_creation(subscription_obj.key)
+        
+    def __queue_creation(self, in_key):
+        future = self.__creation_futures.get(in_key)
+        if future is None or future.done():
+            future = self.__creation_futures[in_key] = self.__loop.create_future()
+        generation = self.__generations.get(in_key, 0) + 1
+        self.__generations[in_key] = generation
+        self.__pending_api_requests.put_nowait((in_key, generation))
+        return future
         
     async def process_api_requests(self):
         while not await self.shutdown_requested():
-            if self.__session:
-                for apireq in self.__pending_api_requests:
-                    await apireq.execute(self.__twitch_api, self.__session.id)
-                self.__pending_api_requests = []
-            await asyncio.sleep(0)
-                
\ No newline at end of file
+            key, generation = await self.__pending_api_requests.get()
+            obj = self.__subscription_objects.get(key)
+            # it got moved to another session or queued again since
+            if obj is None or self.__generations.get(key) != generation:
+                continue
+                
+            try:
+                created = await self.__create_subscription(obj)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                traceback.print_exc()
+                created = False
+                
+            # an attempt from a session that has since dropped doesn't count
+            future = self.__creation_futures.get(key)
+            if self.__generations.get(key) == generation and future and not future.done():
+                future.set_result(created)
+                
+    async def __create_subscription(self, obj):
+        for attempt in range(self.__max_request_attempts):
+            await self.__session_ready.wait()
+            session_id = self.__session.id
+            try:
+                await obj.execute(self.__twitch_api, session_id)
+                return True
+            except TwitchApiError as e:
+                # we already have it
+                if e.status == 409:
+                    return True
+                if not e.is_retryable or attempt + 1 == self.__max_request_attempts:
+                    print(f"Failed to create subscription {obj.key}: {e}")
+                    return False
+                    
+                # exponential backoff with jitter unless helix told us when the bucket refills
+                delay = e.retry_after if e.retry_after is not None else min(2 ** attempt, 30)
+                await asyncio.sleep(delay + random.uniform(0, 0.5))
+        return False
@@ -0,0 +1,124 @@
+import asyncio
+import time
+from stashio.twitch.eventsub.eventsub import EventSubConnection
+from stashio.utils.data import TimingStats
+from stashio.utils.supervisor import Supervisor
+
+class EventSubPool():
+    def __init__(self, in_twitch_api, in_max_subscriptions_per_session=300, in_max_sessions=3, in_server='wss://eventsub.wss.twitch.tv/ws', in_archive=None):
+        # used to make api requests to twitch
+        self.__twitch_api = in_twitch_api
+        # twitch only allows so many enabled subscriptions on one websocket session
+        self.__max_subscriptions_per_session = in_max_subscriptions_per_session
+        # and only so many websocket sessions per user token
+        self.__max_sessions = in_max_sessions
+        self.__server = in_server
+        # every session copies its notifications into the same archive
+        self.__archive = in_archive
+        # the open sessions
+        self.__sessions = []
+        # keeps every session running, restarting any that crash
+        self.__supervisor = Supervisor()
+        # asyncio event loop
+        self.__loop = asyncio.get_event_loop()
+        # session lost -> every subscription it had is created somewhere else
+        self.__recover_times = TimingStats()
+
+    @property
+    def sessions(self):
+        return list(self.__sessions)
+
+    def get_stats(self):
+        return {
+            "recover_lost_session": self.__recover_times.get_stats(),
+            "sessions": [session.get_stats() for session in self.__sessions]
+        }
+
+    def get_session_subscription_counts(self):
+        return [session.subscription_count for session in self.__sessions]
+
+    async def run(self):
+        self.__supervisor.start()
+        await self.__supervisor.wait()
+
+    async def stop(self, in_deadline=10):
+        await self.__supervisor.stop(in_deadline)
+
+    # Returns a future per subscription that resolves to whether twitch accepted it
+    async def channel_subscribe(self, channel_id, subscriptions_and_callbacks):
+        futures = []
+        for sub, callback in subscriptions_and_callbacks:
+            futures.append(await self.eventsub_listen(sub(channel_id), callback))
+        return futures
+
+    async def eventsub_listen(self, obj, callback, in_exclude=None):
+        session = self.__pick_session(obj, in_exclude)
+        if session is None:
+            print("No EventSub session has room for another subscription")
+            future = self.__loop.create_future()
+            future.set_result(False)
+            return future
+        return await session.eventsub_listen(obj, callback)
+
+    def __pick_session(self, obj, in_exclude=None):
+        key = obj.key
+        # a session that already has this subscription just gets another callback for it
+        for session in self.__sessions:
+            if session is not in_exclude and session.has_subscription(key):
+                return session
+                
+        # least loaded session that still has room
+        best = None
+        for session in self.__sessions:
+            if session is in_exclude:
+                continue
+            if session.subscription_count >= self.__max_subscriptions_per_session:
+                continue
+            if best is None or session.subscription_count < best.subscription_count:
+                best = session
+
+        if best is not None:
+            return best
+
+        if len(self.__sessions) < self.__max_sessions:
+            return self.__add_session()
+
+        # the dropped session is the last resort, it'll get a fresh session id when it reconnects
+        if in_exclude is not None and (in_exclude.has_subscription(key) or in_exclude.subscription_count < self.__max_subscriptions_per_session):
+            return in_exclude
+
+        return None
+
+    def __add_session(self):
+        session = EventSubConnection(in_twitch_api=self.__twitch_api, in_server=self.__server, in_on_session_lost=self.__on_session_lost, in_archive=self.__archive)
+        self.__sessions.append(session)
+        self.__supervisor.add(f"eventsub-{len(self.__sessions)}", session.run, session.stop)
+        return session
+
+    async def __on_session_lost(self, in_session, in_subscriptions):
+        lost_at = time.monotonic()
+        new_futures = []
+        # spread everything the dropped session had over the sessions that are still up
+        for obj, callback, future in in_subscriptions:
+            new_future = await self.eventsub_listen(obj, callback, in_exclude=in_session)
+            new_futures.append(new_future)
+            # anyone still waiting on the original creation gets the result from the new session
+            if future is not None and not future.done():
+                new_future.add_done_callback(lambda f, future=future: self.__forward_result(f, future))
+                
+        self.__loop.create_task(self.__time_recovery(lost_at, new_futures))
+
+    def __forward_result(self, in_source, in_target):
+        if in_target.done():
+            return
+        if in_source.cancelled():
+            # the new session never got to try, as far as the caller knows it just didn't get created
+            in_target.set_result(False)
+        elif in_source.exception() is not None:
+            in_target.set_exception(in_source.exception())
+        else:
+            in_target.set_result(in_source.result())
+
+    async def __time_recovery(self, in_lost_at, in_futures):
+        await asyncio.gather(*in_futures, return_exceptions=True)
+        self.__recover_times.add(time.monotonic() - in_lost_at)
@@ -1,12 +1,21 @@
 import ujson
 
+# Identifies a subscription by what twitch sends us for it: (type, version, broadcaster id, reward id)
+def make_subscription_key(in_type, in_version, in_condition):
+    condition = in_condition if in_condition else {}
+    broadcaster_id = condition.get("broadcaster_user_id")
+    reward_id = condition.get("reward_id")
+    return (in_type, str(in_version), str(broadcaster_id) if broadcaster_id is not None else None, str(reward_id) if reward_id else None)
+
 class Message_SessionWelcome():
     def __init__(self, in_payload):
         session = in_payload["session"]
         self.__id = session["id"]
         self.__status = session["status"]
         self.__connected_at = session["connected_at"]
-        self.__keepalive_timeout_seconds = int(session["keepalive_timeout_seconds"]) + 3
+        # session_reconnect messages carry the same session object, without a keepalive timeout
+        keepalive_timeout = session.get("keepalive_timeout_seconds")
+        self.__keepalive_timeout_seconds = int(keepalive_timeout) + 3 if keepalive_timeout is not None else None
         self.__reconnect_url = session["reconnect_url"]
         
     @property
@@ -25,6 +34,10 @@ class Message_SessionWelcome():
     def keepalive_timeout(self):
         return self.__keepalive_timeout_seconds
         
+    @property
+    def reconnect_url(self):
+        return self.__reconnect_url
+        
 class Message_ChannelRewardRedemption():
     def __init__(self, in_payload):
         pass
@@ -70,6 +83,14 @@ class EventSubscriptionType():
     def type(self):
         return self.__type
         
+    @property
+    def version(self):
+        return self.__version
+        
+    @property
+    def key(self):
+        return make_subscription_key(self.__type, self.__version, self.GetCondition())
+        
     def GetJson(self, session_id):
         packet = {
             "type": self.__type,
@@ -83,7 +104,7 @@ class EventSubscriptionType():
         return packet
         
     async def execute(self, twitch_api, session_id):
-        await twitch_api.EventSub_CreateSubscription(self.GetJson(session_id))
+        return await twitch_api.EventSub_CreateSubscription(self.GetJson(session_id))
         
     # override in child class with proper condition for the subscription type
     def GetCondition(self):
@@ -0,0 +1,157 @@
+import asyncio
+import time
+from collections import deque
+
+class RequestPriority():
+    # someone is waiting on the answer, like a chat command
+    INTERACTIVE = 0
+    # background work that can wait, like refreshing the user bank or creating subscriptions
+    BULK = 1
+
+class HelixRateLimiter():
+    def __init__(self, in_limit=800, in_bulk_reserve=0.1, in_unknown_reset_wait=1):
+        # points in the bucket, twitch tells us the real number with every response
+        self.__limit = in_limit
+        self.__remaining = in_limit
+        # unix time the bucket is full again, if we know it
+        self.__reset_time = None
+        # share of the bucket only interactive requests are allowed to use
+        self.__bulk_reserve = in_bulk_reserve
+        # how long to wait for a refill when twitch hasn't told us when it happens
+        self.__unknown_reset_wait = in_unknown_reset_wait
+        # requests that took a point but haven't gotten a response yet
+        self.__in_flight = 0
+        # priority -> futures waiting for a point, in the order they asked
+        self.__waiters = {RequestPriority.INTERACTIVE: deque(), RequestPriority.BULK: deque()}
+        self.__wakeup_handle = None
+        self.__loop = asyncio.get_event_loop()
+        # counters
+        self.__granted = {RequestPriority.INTERACTIVE: 0, RequestPriority.BULK: 0}
+        self.__waited = {RequestPriority.INTERACTIVE: 0, RequestPriority.BULK: 0}
+        self.__rate_limited = 0
+
+    def get_stats(self):
+        return {
+            "limit": self.__limit,
+            "remaining": self.__remaining,
+            "in_flight": self.__in_flight,
+            "waiting_interactive": len(self.__waiters[RequestPriority.INTERACTIVE]),
+            "waiting_bulk": len(self.__waiters[RequestPriority.BULK]),
+            "granted_interactive": self.__granted[RequestPriority.INTERACTIVE],
+            "granted_bulk": self.__granted[RequestPriority.BULK],
+            "waited_interactive": self.__waited[RequestPriority.INTERACTIVE],
+            "waited_bulk": self.__waited[RequestPriority.BULK],
+            "rate_limited": self.__rate_limited
+        }
+
+    # Waits until the request is allowed to go out, every acquire needs a matching release
+    async def acquire(self, in_priority=RequestPriority.INTERACTIVE):
+        if not self.__has_waiters(in_priority) and self.__can_grant(in_priority):
+            self.__grant(in_priority)
+            return
+
+        future = self.__loop.create_future()
+        self.__waiters[in_priority].append(future)
+        self.__waited[in_priority] += 1
+        self.__schedule_wakeup()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # we were handed a point just as we got cancelled, give it back
+                self.release()
+            raise
+
+    # Call when the response comes back, with its headers so we stay in sync with twitch.
+    # Without headers the request never got an answer (timeout, connection error, cancelled), so its point is given back.
+    def release(self, in_headers=None):
+        self.__in_flight = max(self.__in_flight - 1, 0)
+        if in_headers is not None:
+            self.__sync(in_headers)
+        else:
+            self.__remaining = min(self.__remaining + 1, max(self.__limit - self.__in_flight, 0))
+        self.__release_waiters()
+
+    # Call on a 429, nothing else goes out until the bucket resets
+    def on_rate_limited(self, in_headers=None):
+        self.__rate_limited += 1
+        self.__remaining = 0
+        if in_headers is not None:
+            reset = self.__parse_int(in_headers.get('Ratelimit-Reset'))
+            if reset is not None:
+                self.__reset_time = reset
+        if self.__reset_time is None or self.__reset_time <= time.time():
+            self.__reset_time = time.time() + self.__unknown_reset_wait
+        self.__schedule_wakeup()
+
+    def __parse_int(self, in_value):
+        try:
+            return int(in_value) if in_value is not None else None
+        except ValueError:
+            return None
+
+    def __sync(self, in_headers):
+        limit = self.__parse_int(in_headers.get('Ratelimit-Limit'))
+        remaining = self.__parse_int(in_headers.get('Ratelimit-Remaining'))
+        reset = self.__parse_int(in_headers.get('Ratelimit-Reset'))
+        if limit is not None:
+            self.__limit = limit
+        if remaining is not None:
+            # requests still in flight will come out of what twitch just told us
+            self.__remaining = max(remaining - self.__in_flight, 0)
+        if reset is not None:
+            self.__reset_time = reset
+
+    def __refill(self):
+        if self.__reset_time is not None and self.__reset_time <= time.time():
+            self.__remaining = max(self.__limit - self.__in_flight, 0)
+            self.__reset_time = None
+
+    def __has_waiters(self, in_priority):
+        # nobody gets to cut in front of a request of the same or higher priority
+        return any(len(self.__waiters[priority]) > 0 for priority in self.__waiters if priority <= in_priority)
+
+    def __can_grant(self, in_priority):
+        self.__refill()
+        reserve = int(self.__limit * self.__bulk_reserve) if in_priority == RequestPriority.BULK else 0
+        return self.__remaining > reserve
+
+    def __grant(self, in_priority):
+        self.__remaining -= 1
+        self.__in_flight += 1
+        self.__granted[in_priority] += 1
+        # an empty bucket always has a refill coming, even if no response ever tells us when
+        if self.__remaining <= 0 and self.__reset_time is None:
+            self.__reset_time = time.time() + self.__unknown_reset_wait
+
+    def __release_waiters(self):
+        for priority in sorted(self.__waiters):
+            waiters = self.__waiters[priority]
+            while len(waiters) > 0 and self.__can_grant(priority):
+                future = waiters.popleft()
+                if future.done():
+                    continue
+                self.__grant(priority)
+                future.set_result(True)
+
+            # lower priorities wait until this lane is empty
+            if len(waiters) > 0:
+                break
+
+        self.__schedule_wakeup()
+
+    def __schedule_wakeup(self):
+        if self.__wakeup_handle is not None:
+            self.__wakeup_handle.cancel()
+            self.__wakeup_handle = None
+
+        if not any(len(waiters) > 0 for waiters in self.__waiters.values()):
+            return
+
+        # responses coming back will also wake us up, this is for when nothing is in flight
+        reset_time = self.__reset_time if self.__reset_time is not None else time.time() + self.__unknown_reset_wait
+        self.__wakeup_handle = self.__loop.call_later(max(reset_time - time.time(), 0), self.__on_wakeup)
+
+    def __on_wakeup(self):
+        self.__wakeup_handle = None
+        self.__release_waiters()
@@ -0,0 +1,206 @@
+import asyncio
+import os
+import sqlite3
+import ujson
+from concurrent.futures import ThreadPoolExecutor
+from stashio.utils.data import TTLCache
+
+class UserStore():
+    def __init__(self, in_db_path='stashio/data/userbank.db', in_hot_size=10000, in_flush_window=0.5, in_batch_size=500):
+        self.__path = in_db_path
+        # sqlite calls block, so they all run on one thread that owns the connection
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="stashio-userstore")
+        self.__db = None
+        self.__open_lock = asyncio.Lock()
+        # the most recently used users, so hot lookups never touch the disk
+        self.__hot_ids = TTLCache(in_hot_size)
+        self.__hot_logins = TTLCache(in_hot_size)
+        # users we know about that haven't been written yet, id -> login and login -> id
+        self.__pending = dict()
+        self.__pending_logins = dict()
+        # how long to collect writes before committing them as one transaction
+        self.__flush_window = in_flush_window
+        self.__batch_size = in_batch_size
+        self.__flush_handle = None
+        self.__flush_lock = asyncio.Lock()
+        self.__loop = asyncio.get_event_loop()
+        # counters
+        self.__disk_reads = 0
+        self.__disk_writes = 0
+        self.__flushes = 0
+
+    def get_stats(self):
+        return {
+            "hot_ids": self.__hot_ids.get_stats(),
+            "hot_logins": self.__hot_logins.get_stats(),
+            "pending": len(self.__pending),
+            "disk_reads": self.__disk_reads,
+            "disk_writes": self.__disk_writes,
+            "flushes": self.__flushes
+        }
+
+    async def __run(self, func, *args):
+        return await self.__loop.run_in_executor(self.__executor, func, *args)
+
+    async def open(self):
+        if self.__db is not None:
+            return
+
+        async with self.__open_lock:
+            if self.__db is None:
+                self.__db = await self.__run(self.__open_db)
+
+    def __open_db(self):
+        directory = os.path.dirname(self.__path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        db = sqlite3.connect(self.__path, check_same_thread=False)
+        # readers don't block the writer and commits don't rewrite the file
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("CREATE TABLE IF NOT EXISTS users (id TEXT PRIMARY KEY, login TEXT NOT NULL)")
+        db.execute("CREATE INDEX IF NOT EXISTS users_login ON users (login)")
+        db.commit()
+        return db
+
+    async def close(self):
+        await self.flush()
+        if self.__db is not None:
+            await self.__run(self.__db.close)
+            self.__db = None
+        self.__executor.shutdown(wait=False)
+
+    # One time import of the old json userbank, the file is renamed afterwards so it only happens once
+    async def migrate_json(self, in_json_path):
+        if not os.path.exists(in_json_path):
+            return 0
+
+        await self.open()
+        count = await self.__run(self.__migrate_json, in_json_path)
+        print(f"Migrated {count} users from {in_json_path}")
+        return count
+
+    def __migrate_json(self, in_json_path):
+        with open(in_json_path, 'r') as f:
+            userbank = ujson.load(f)
+
+        rows = list(userbank.get("userlookup", dict()).items())
+        # logins that only made it into one side of the old lookup
+        known_ids = set(id for id, _ in rows)
+        rows += [(id, login) for login, id in userbank.get("idlookup", dict()).items() if not id in known_ids]
+        self.__write_rows(rows)
+        os.replace(in_json_path, in_json_path + ".migrated")
+        return len(rows)
+
+    def __write_rows(self, in_rows):
+        with self.__db:
+            # a login can only belong to one account, the old owner must have been renamed
+            self.__db.executemany("DELETE FROM users WHERE login = ? AND id != ?", [(login, id) for id, login in in_rows])
+            self.__db.executemany("INSERT OR REPLACE INTO users (id, login) VALUES (?, ?)", in_rows)
+
+    def __remember(self, in_id, in_login):
+        old_login = self.__hot_ids.peek(in_id)
+        if old_login is not None and old_login != in_login:
+            self.__hot_logins.invalidate(old_login)
+        self.__hot_ids.set(in_id, in_login)
+        self.__hot_logins.set(in_login, in_id)
+
+    async def get_id(self, in_login):
+        login = in_login.lower()
+        id = self.__hot_logins.get(login)
+        if id is None:
+            id = self.__pending_logins.get(login)
+        if id is None:
+            await self.open()
+            self.__disk_reads += 1
+            row = await self.__run(self.__select, "SELECT id FROM users WHERE login = ?", login)
+            if row is None:
+                return None
+            id = row[0]
+
+        self.__remember(id, login)
+        return id
+
+    async def get_login(self, in_id):
+        id = str(in_id)
+        login = self.__hot_ids.get(id)
+        if login is None:
+            login = self.__pending.get(id)
+        if login is None:
+            await self.open()
+            self.__disk_reads += 1
+            row = await self.__run(self.__select, "SELECT login FROM users WHERE id = ?", id)
+            if row is None:
+                return None
+            login = row[0]
+
+        self.__remember(id, login)
+        return login
+
+    def __select(self, in_query, in_value):
+        return self.__db.execute(in_query, (in_value,)).fetchone()
+
+    async def get_all_ids(self):
+        await self.flush()
+        await self.open()
+        rows = await self.__run(lambda: self.__db.execute("SELECT id FROM users").fetchall())
+        return [row[0] for row in rows]
+
+    # Swaps everything we know for in_users in one transaction
+    async def replace_all(self, in_users):
+        await self.flush()
+        await self.open()
+        self.__hot_ids.clear()
+        self.__hot_logins.clear()
+        rows = list(in_users)
+        await self.__run(self.__replace_rows, rows)
+        self.__disk_writes += len(rows)
+        self.__flushes += 1
+
+    def __replace_rows(self, in_rows):
+        with self.__db:
+            self.__db.execute("DELETE FROM users")
+            self.__db.executemany("INSERT OR REPLACE INTO users (id, login) VALUES (?, ?)", in_rows)
+
+    # Users are in memory right away, the disk write happens with the next batch
+    def put_many(self, in_users):
+        for id, login in in_users:
+            old_login = self.__pending.get(id)
+            if old_login is not None and old_login != login:
+                self.__pending_logins.pop(old_login, None)
+            self.__pending[id] = login
+            self.__pending_logins[login] = id
+            self.__remember(id, login)
+
+        if len(self.__pending) >= self.__batch_size:
+            self.__loop.create_task(self.flush())
+        elif self.__flush_handle is None and len(self.__pending) > 0:
+            self.__flush_handle = self.__loop.call_later(self.__flush_window, lambda: self.__loop.create_task(self.flush()))
+
+    async def flush(self):
+        if self.__flush_handle:
+            self.__flush_handle.cancel()
+            self.__flush_handle = None
+
+        # one writer at a time so batches land in the order they were made
+        async with self.__flush_lock:
+            if len(self.__pending) == 0:
+                return
+
+            rows = list(self.__pending.items())
+            await self.open()
+            try:
+                await self.__run(self.__write_rows, rows)
+            except Exception as e:
+                print("Failed to save users:", e)
+                return
+
+            for id, login in rows:
+                # only forget it if nothing newer came in while we were writing
+                if self.__pending.get(id) == login:
+                    del self.__pending[id]
+                    if self.__pending_logins.get(login) == id:
+                        del self.__pending_logins[login]
+            self.__disk_writes += len(rows)
+            self.__flushes += 1
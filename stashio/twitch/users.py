@@ -1,63 +1,153 @@
-import ujson
-import aiofiles
+import asyncio
+from stashio.twitch.user_store import UserStore
+from stashio.twitch.rate_limiter import RequestPriority
+
+class UserLoader():
+    def __init__(self, in_twitch_api, in_on_results, in_window=0.01, in_batch_size=100):
+        self.__api = in_twitch_api
+        # called with every user data dict from a batch, before any waiting caller is resolved
+        self.__on_results = in_on_results
+        # how long to collect lookups before sending them
+        self.__window = in_window
+        # helix takes up to 100 logins/ids per call
+        self.__batch_size = in_batch_size
+        # login/id -> future, for lookups that haven't been sent yet or are waiting on a response
+        self.__logins = dict()
+        self.__ids = dict()
+        # the lookups collected for the next batch
+        self.__queued_logins = []
+        self.__queued_ids = []
+        self.__flush_handle = None
+        self.__loop = asyncio.get_event_loop()
+        
+    async def load_login(self, in_login):
+        login = in_login.lower()
+        # one caller getting cancelled shouldn't cancel the lookup for everyone else
+        if login in self.__logins:
+            return await asyncio.shield(self.__logins[login])
+            
+        future = self.__logins[login] = self.__loop.create_future()
+        self.__queued_logins.append(login)
+        self.__schedule_flush()
+        return await asyncio.shield(future)
+        
+    async def load_id(self, in_id):
+        id = str(in_id)
+        # one caller getting cancelled shouldn't cancel the lookup for everyone else
+        if id in self.__ids:
+            return await asyncio.shield(self.__ids[id])
+            
+        future = self.__ids[id] = self.__loop.create_future()
+        self.__queued_ids.append(id)
+        self.__schedule_flush()
+        return await asyncio.shield(future)
+        
+    def __schedule_flush(self):
+        if len(self.__queued_logins) + len(self.__queued_ids) >= self.__batch_size:
+            self.__flush()
+        elif self.__flush_handle is None:
+            self.__flush_handle = self.__loop.call_later(self.__window, self.__flush)
+            
+    def __flush(self):
+        if self.__flush_handle:
+            self.__flush_handle.cancel()
+            self.__flush_handle = None
+            
+        logins = self.__queued_logins
+        ids = self.__queued_ids
+        self.__queued_logins = []
+        self.__queued_ids = []
+        if len(logins) > 0 or len(ids) > 0:
+            self.__loop.create_task(self.__fetch(logins, ids))
+        
+    async def __fetch(self, in_logins, in_ids):
+        found = []
+        try:
+            # GetUsers splits these into requests of 100 and sends them together
+            results = await self.__api.GetUsers(users=in_logins, ids=in_ids)
+            for result in results:
+                if isinstance(result, Exception) or not "data" in result:
+                    print("Failed to look up users:", result)
+                    continue
+                found += result["data"]
+                
+            if len(found) > 0:
+                await self.__on_results(found)
+        except Exception as e:
+            print("Failed to look up users:", e)
+            
+        by_login = {user_data["login"]: user_data for user_data in found}
+        by_id = {user_data["id"]: user_data for user_data in found}
+        for login in in_logins:
+            future = self.__logins.pop(login, None)
+            if future and not future.done():
+                future.set_result(by_login.get(login))
+        for id in in_ids:
+            future = self.__ids.pop(id, None)
+            if future and not future.done():
+                future.set_result(by_id.get(id))
 
 class UserBank():
-    def __init__(self, in_twitch_api, in_bank_path='stashio/data/userbank.dat'):
+    def __init__(self, in_twitch_api, in_db_path='stashio/data/userbank.db', in_legacy_bank_path='stashio/data/userbank.dat', in_hot_size=10000):
         self.__api = in_twitch_api
-        self.__path = in_bank_path
-        with open(in_bank_path, 'r') as f:
-            self.__userbank = ujson.load(f)
-            
-        if not "idlookup" in self.__userbank:
-            self.__userbank["idlookup"] = dict()
-        if not "userlookup" in self.__userbank:
-            self.__userbank["userlookup"] = dict()
-            
-    async def __save_bank(self):
-        async with aiofiles.open(self.__path, 'w') as f:
-            await f.write(ujson.dumps(self.__userbank, sort_keys=True, indent=2))
-            await f.flush()
+        # batches cache misses into as few GetUsers calls as possible
+        self.__loader = UserLoader(in_twitch_api, self.__save_users)
+        # indexed on disk storage with the most used users kept in memory
+        self.__store = UserStore(in_db_path, in_hot_size)
+        # the old json bank gets imported the first time we touch the store
+        self.__legacy_bank_path = in_legacy_bank_path
+        self.__migrated = False
+        # callers wait for a migration that is already running instead of reading a half filled store
+        self.__migrate_lock = asyncio.Lock()
+        
+    @property
+    def store(self):
+        return self.__store
+        
+    async def __ensure_migrated(self):
+        if self.__migrated:
+            return
+            
+        async with self.__migrate_lock:
+            if not self.__migrated:
+                # a failed import raises and gets tried again by the next caller
+                await self.__store.migrate_json(self.__legacy_bank_path)
+                self.__migrated = True
+            
+    async def close(self):
+        await self.__store.close()
 
-    async def __save_result(self, result):
-        for user_data in result[0]["data"]:
-            found_id = user_data["id"]
-            found_user = user_data["login"]
-            self.__userbank["idlookup"][found_user] = found_id
-            self.__userbank["userlookup"][found_id] = found_user
-        await self.__save_bank()
+    async def __save_users(self, users):
+        self.__store.put_many([(user_data["id"], user_data["login"]) for user_data in users])
 
     async def refresh_user_bank(self):
-        ids = self.__userbank["userlookup"].keys()
-        self.__userbank["idlookup"] = dict()
-        self.__userbank["userlookup"] = dict()
-        result = await self.__api.GetUsers(ids=ids)
-        await self.__save_result(result)
+        await self.__ensure_migrated()
+        ids = await self.__store.get_all_ids()
+        # a refresh can be thousands of users, so it waits behind anything a chat handler needs
+        results = await self.__api.GetUsers(ids=ids, priority=RequestPriority.BULK)
+        users = []
+        for result in results:
+            if isinstance(result, Exception) or not "data" in result:
+                print("Failed to refresh users:", result)
+                return
+            users += result["data"]
+        await self.__store.replace_all([(user_data["id"], user_data["login"]) for user_data in users])
             
         
     async def get_channel_id(self, in_username):
-        if in_username in self.__userbank["idlookup"]:
-            return self.__userbank["idlookup"][in_username]
+        await self.__ensure_migrated()
+        id = await self.__store.get_id(in_username)
+        if id is not None:
+            return id
             
-        result = await self.__api.GetUsers([in_username])
-        
-        if result:
-            data = result[0]["data"]
-            if len(data) > 0:
-                await self.__save_result(result)
-                found_id = result[0]["data"][0]["id"]
-                return found_id
-            
-        return None
+        user_data = await self.__loader.load_login(in_username)
+        return user_data["id"] if user_data else None
         
     async def get_username_from_id(self, in_id):
-        if in_id in self.__userbank["userlookup"]:
-            return self.__userbank["userlookup"][in_id]
-            
-        result = await self.__api.GetUsers(ids=[in_id])
-        
-        if result:
-            await self.__save_result(result)
-            found_user = result[0]["data"][0]["login"]
-            return found_user
+        await self.__ensure_migrated()
+        login = await self.__store.get_login(in_id)
+        if login is not None:
+            return login
             
-        return None
+        user_data = await self.__loader.load_id(in_id)
+        return user_data["login"] if user_data else None
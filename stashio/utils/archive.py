@@ -0,0 +1,243 @@
+import asyncio
+import gzip
+import os
+import re
+import time
+import traceback
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# compression -> file extension
+COMPRESSION_EXTENSIONS = {None: "", "gzip": ".gz", "zstd": ".zst"}
+
+# anything else in a channel name gets replaced, so a name can never point outside the archive
+UNSAFE_PATH_CHARACTERS = re.compile(r'[^A-Za-z0-9_\-]')
+
+class ChatArchive():
+    def __init__(self, in_directory='stashio/data/archive', in_compression=None, in_flush_interval=1, in_batch_bytes=1024*1024,
+                 in_max_buffered_bytes=16*1024*1024, in_max_open_files=256, in_rate_window=10):
+        if not in_compression in COMPRESSION_EXTENSIONS:
+            raise ValueError(f"Unknown archive compression '{in_compression}'")
+        if in_compression == "zstd" and zstandard is None:
+            raise ValueError("zstd archive compression needs the zstandard package")
+
+        # files end up in <directory>/<source>/<channel>/<YYYY-MM-DD>/<HH>.log, hours are utc
+        self.__directory = in_directory
+        self.__compression = in_compression
+        # the writer wakes up this often, or sooner once in_batch_bytes are waiting
+        self.__flush_interval = in_flush_interval
+        self.__batch_bytes = in_batch_bytes
+        # records that come in while this much is waiting to be written get dropped instead of growing memory
+        self.__max_buffered_bytes = in_max_buffered_bytes
+        # (source, channel) -> (hour, file, underlying raw file), the least recently written ones get closed past in_max_open_files
+        self.__max_open_files = in_max_open_files
+        self.__files = OrderedDict()
+        # (source, channel, unix time, line) waiting for the writer
+        self.__buffer = []
+        self.__buffered_bytes = 0
+        # bytes in the batch the writer is working on, they still count against the limit
+        self.__writing_bytes = 0
+        self.__wakeup = asyncio.Event()
+        # one thread does all the file work, so compression never runs on the loop, stop() shuts it down and start() makes a new one
+        self.__executor = self.__create_executor()
+        self.__writer = None
+        # tells the writer to finish the batch it has and exit
+        self.__stopping = False
+        self.__loop = asyncio.get_event_loop()
+        # (monotonic time, payload bytes, disk bytes) per batch written within the last in_rate_window seconds
+        self.__rate_window = in_rate_window
+        self.__recent_batches = deque()
+        # counters
+        self.__records = 0
+        # what the lines add up to, and what actually reached the files after compression (minus the few trailer bytes written on close)
+        self.__payload_bytes = 0
+        self.__disk_bytes = 0
+        self.__batches = 0
+        self.__dropped = 0
+        self.__rotations = 0
+        self.__failed = 0
+
+    def get_stats(self):
+        self.__prune_recent_batches()
+        return {
+            "records": self.__records,
+            "payload_bytes": self.__payload_bytes,
+            "payload_bytes_per_second": sum(payload for _, payload, _ in self.__recent_batches) / self.__rate_window,
+            "disk_bytes": self.__disk_bytes,
+            "disk_bytes_per_second": sum(disk for _, _, disk in self.__recent_batches) / self.__rate_window,
+            "batches": self.__batches,
+            "buffered_bytes": self.__buffered_bytes + self.__writing_bytes,
+            "dropped": self.__dropped,
+            "open_files": len(self.__files),
+            "rotations": self.__rotations,
+            "failed": self.__failed
+        }
+
+    def __create_executor(self):
+        return ThreadPoolExecutor(max_workers=1, thread_name_prefix="stashio-archive")
+
+    def start(self):
+        if self.__executor is None:
+            self.__executor = self.__create_executor()
+        self.__stopping = False
+        if self.__writer is None or self.__writer.done():
+            self.__writer = self.__loop.create_task(self.__write_loop())
+
+    # Writes out whatever is buffered and closes every file
+    async def stop(self):
+        if self.__executor is None:
+            return
+
+        # the batch the writer is in the middle of gets finished and counted, not cut off
+        self.__stopping = True
+        self.__wakeup.set()
+        if self.__writer is not None:
+            await asyncio.gather(self.__writer, return_exceptions=True)
+            self.__writer = None
+
+        await self.__write_buffer()
+        await self.__loop.run_in_executor(self.__executor, self.__close_files)
+        self.__executor.shutdown(wait=True)
+        self.__executor = None
+
+    # Queues a raw line, returns False if it got dropped because the writer is too far behind
+    def write(self, in_source, in_channel, in_line):
+        size = len(in_line) + 1
+        if self.__buffered_bytes + self.__writing_bytes + size > self.__max_buffered_bytes:
+            self.__dropped += 1
+            return False
+
+        self.__buffer.append((in_source, in_channel, time.time(), in_line))
+        self.__buffered_bytes += size
+        if self.__buffered_bytes >= self.__batch_bytes:
+            self.__wakeup.set()
+        return True
+
+    async def __write_loop(self):
+        while not self.__stopping:
+            try:
+                await asyncio.wait_for(self.__wakeup.wait(), self.__flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.__write_buffer()
+
+    async def __write_buffer(self):
+        self.__wakeup.clear()
+        if len(self.__buffer) == 0:
+            return
+
+        batch = self.__buffer
+        size = self.__buffered_bytes
+        self.__buffer = []
+        self.__buffered_bytes = 0
+        self.__writing_bytes = size
+        try:
+            payload, disk = await self.__loop.run_in_executor(self.__executor, self.__write_batch, batch)
+            self.__records += len(batch)
+            self.__payload_bytes += payload
+            self.__disk_bytes += disk
+            self.__batches += 1
+            self.__recent_batches.append((time.monotonic(), payload, disk))
+        except Exception:
+            self.__failed += 1
+            self.__dropped += len(batch)
+            print(f"Failed to archive {len(batch)} records")
+            traceback.print_exc()
+        finally:
+            self.__writing_bytes = 0
+
+    def __prune_recent_batches(self):
+        cutoff = time.monotonic() - self.__rate_window
+        while len(self.__recent_batches) > 0 and self.__recent_batches[0][0] < cutoff:
+            self.__recent_batches.popleft()
+
+    #############################################################
+    ## Everything below runs on the archive thread
+    #############################################################
+
+    # Returns (payload bytes, bytes that reached the files)
+    def __write_batch(self, in_batch):
+        # (source, channel) -> (hour, [encoded lines]), so each file gets one write per batch
+        grouped = dict()
+        payload = 0
+        disk = 0
+        for source, channel, timestamp, line in in_batch:
+            hour = int(timestamp // 3600)
+            key = (source, channel or "")
+            entry = grouped.get(key)
+            if entry is None or entry[0] != hour:
+                # a batch that spans an hour boundary writes what it has to the old hour first
+                if entry is not None:
+                    written = self.__write_lines(key, entry[0], entry[1])
+                    payload += written[0]
+                    disk += written[1]
+                entry = grouped[key] = (hour, [])
+            entry[1].append(f"{timestamp:.3f}\t{line}\n".encode('utf-8'))
+
+        for key, (hour, lines) in grouped.items():
+            written = self.__write_lines(key, hour, lines)
+            payload += written[0]
+            disk += written[1]
+        return payload, disk
+
+    def __write_lines(self, in_key, in_hour, in_lines):
+        data = b"".join(in_lines)
+        f, raw = self.__get_file(in_key, in_hour)
+        start = raw.tell()
+        f.write(data)
+        # readable on disk after every batch, even while the file is still open
+        f.flush()
+        return len(data), raw.tell() - start
+
+    # Returns (file to write lines to, the file underneath it that holds the compressed bytes)
+    def __get_file(self, in_key, in_hour):
+        entry = self.__files.get(in_key)
+        if entry is not None:
+            if entry[0] == in_hour:
+                self.__files.move_to_end(in_key)
+                return entry[1], entry[2]
+            self.__rotations += 1
+            self.__close_file(in_key)
+
+        while len(self.__files) >= self.__max_open_files:
+            self.__close_file(next(iter(self.__files)))
+
+        f, raw = self.__open_file(self.__get_path(in_key, in_hour))
+        self.__files[in_key] = (in_hour, f, raw)
+        return f, raw
+
+    def __get_path(self, in_key, in_hour):
+        source, channel = in_key
+        date = time.strftime("%Y-%m-%d", time.gmtime(in_hour * 3600))
+        hour = time.strftime("%H", time.gmtime(in_hour * 3600))
+        channel = UNSAFE_PATH_CHARACTERS.sub("_", channel) or "_"
+        return os.path.join(self.__directory, UNSAFE_PATH_CHARACTERS.sub("_", source), channel, date, f"{hour}.log{COMPRESSION_EXTENSIONS[self.__compression]}")
+
+    def __open_file(self, in_path):
+        os.makedirs(os.path.dirname(in_path), exist_ok=True)
+        raw = open(in_path, 'ab')
+        # appending starts a new gzip member or zstd frame, readers treat the file as one stream
+        if self.__compression == "gzip":
+            return gzip.GzipFile(fileobj=raw, mode='ab'), raw
+        if self.__compression == "zstd":
+            return zstandard.ZstdCompressor().stream_writer(raw), raw
+        return raw, raw
+
+    def __close_file(self, in_key):
+        _, f, raw = self.__files.pop(in_key)
+        try:
+            f.close()
+            # gzip leaves the file it was given open
+            raw.close()
+        except Exception:
+            self.__failed += 1
+            traceback.print_exc()
+
+    def __close_files(self):
+        for key in list(self.__files):
+            self.__close_file(key)
@@ -1,13 +1,36 @@
+import asyncio
 import json
+import time
+import traceback
 import requests
-import aiohttp
+from stashio.utils.http import HttpSession
+from stashio.utils.singleflight import SingleFlight
+from stashio.utils.persistence import PersistenceService
 
 class Auth():
-    def __init__(self, auth_file):
+    def __init__(self, auth_file, in_http=None, in_refresh_margin=300, in_persistence=None):
         self.__auth_file = auth_file
         self.__auth_json = {}
+        # writes the auth file off the event loop
+        self.__persistence = in_persistence if in_persistence else PersistenceService()
+        # pooled connections shared with the twitch api
+        self.__http = in_http if in_http else HttpSession()
+        # everyone that needs a refresh at the same time shares one, so the refresh token only gets used once
+        self.__single_flight = SingleFlight()
+        # token kind -> unix time the token expires, None until twitch tells us
+        self.__expires_at = {"helix": None, "irc": None}
+        # how long before expiry we refresh
+        self.__refresh_margin = in_refresh_margin
+        # background task that refreshes tokens before they expire
+        self.__refresh_task = None
+        # wakes up the refresh task when an expiry changes
+        self.__expiry_changed = asyncio.Event()
         self.__load_auth()
         
+    @property
+    def http(self):
+        return self.__http
+        
     def get_user(self):
         return self.__auth_json['username']
     
@@ -32,6 +55,35 @@ class Auth():
     def get_funtoon_token(self):
         return self.__auth_json['funtoon_token']
         
+    def get_expires_at(self, in_kind="helix"):
+        return self.__expires_at[in_kind]
+        
+    # Returns the helix token, waiting for a refresh first if one is running or the token is about to expire
+    async def get_valid_access_token(self):
+        if self.__needs_refresh("helix"):
+            await self.refresh_access_token()
+        return self.get_access_token()
+        
+    # Same as get_valid_access_token but for the chat token
+    async def get_valid_irc_token(self):
+        if self.__needs_refresh("irc"):
+            await self.refresh_irc_access_token()
+        return self.get_irc_token()
+        
+    def start(self):
+        if self.__refresh_task is None:
+            self.__refresh_task = asyncio.get_event_loop().create_task(self.__refresh_loop())
+            
+    def stop(self):
+        if self.__refresh_task is not None:
+            self.__refresh_task.cancel()
+            self.__refresh_task = None
+            
+    # Stops refreshing and waits for the auth file to be written
+    async def close(self):
+        self.stop()
+        await self.__persistence.flush(self.__auth_file)
+        
     def __get_oauth_header(self, content_type=None):
         out = {
             'client-id': self.get_client_id(),
@@ -44,20 +96,34 @@ class Auth():
         return out
 
     async def validate_access_token(self):
+        return await self.__validate("helix", self.get_access_token())
+        
+    async def validate_irc_access_token(self):
+        return await self.__validate("irc", self.get_irc_token().replace("oauth:", ""))
+        
+    async def __validate(self, in_kind, in_token):
         headers = {
-            'Authorization': f'OAuth {self.get_access_token()}'
+            'Authorization': f'OAuth {in_token}'
         }
         
         try:
-            async with aiohttp.ClientSession(headers=self.__get_oauth_header()) as session:
-                async with session.get('https://id.twitch.tv/oauth2/validate') as r:
-                    j = await r.json()
-                    return 'client_id' in j
+            session = await self.__http.get()
+            async with session.get('https://id.twitch.tv/oauth2/validate', headers=headers) as r:
+                j = await r.json()
+                if 'expires_in' in j:
+                    self.__set_expires_in(in_kind, j['expires_in'])
+                return 'client_id' in j
         except:
             print("Can't validate access token")
             return None
         
-    async def refresh_access_token(self):
+    # If in_stale_token is given and the token has already changed since then, nothing gets refreshed
+    async def refresh_access_token(self, in_stale_token=None):
+        if in_stale_token is not None and in_stale_token != self.get_access_token():
+            return self.get_access_token()
+        return await self.__single_flight.do("helix", self.__refresh_access_token)
+        
+    async def __refresh_access_token(self):
         params = {
             'grant_type': 'refresh_token',
             'refresh_token': self.get_refresh_token(),
@@ -68,18 +134,24 @@ class Auth():
         url = 'https://id.twitch.tv/oauth2/token'
         #print("Refreshing access token")
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=params) as r:
-                    j = await r.json()
-                    new_access_token = j['access_token']
-                    new_refresh_token = j['refresh_token']
-                    self.__assign_new_access_token(new_access_token, new_refresh_token)
-                    return new_access_token
+            session = await self.__http.get()
+            async with session.post(url, json=params) as r:
+                j = await r.json()
+                new_access_token = j['access_token']
+                new_refresh_token = j['refresh_token']
+                self.__assign_new_access_token(new_access_token, new_refresh_token)
+                self.__set_expires_in("helix", j.get('expires_in'))
+                return new_access_token
         except Exception as e:
             print(e)
             return None
         
-    async def refresh_irc_access_token(self):
+    async def refresh_irc_access_token(self, in_stale_token=None):
+        if in_stale_token is not None and in_stale_token != self.get_irc_token():
+            return self.get_irc_token()
+        return await self.__single_flight.do("irc", self.__refresh_irc_access_token)
+        
+    async def __refresh_irc_access_token(self):
         params = {
             'grant_type': 'refresh_token',
             'refresh_token': self.get_irc_refresh_token(),
@@ -90,15 +162,16 @@ class Auth():
         url = 'https://id.twitch.tv/oauth2/token'
         #print("Refreshing access token")
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=params) as r:
-                    j = await r.json()
-                    new_access_token = j['access_token']
-                    new_refresh_token = j['refresh_token']
-                    if not "oauth:" in new_access_token:
-                        new_access_token = "oauth:" + new_access_token
-                    self.__assign_new_irc_access_token(new_access_token, new_refresh_token)
-                    return new_access_token
+            session = await self.__http.get()
+            async with session.post(url, json=params) as r:
+                j = await r.json()
+                new_access_token = j['access_token']
+                new_refresh_token = j['refresh_token']
+                if not "oauth:" in new_access_token:
+                    new_access_token = "oauth:" + new_access_token
+                self.__assign_new_irc_access_token(new_access_token, new_refresh_token)
+                self.__set_expires_in("irc", j.get('expires_in'))
+                return new_access_token
         except Exception as e:
             print(e)
             return None
@@ -106,6 +179,45 @@ class Auth():
     ###########################################################################
     # Private helper methods
     ###########################################################################
+    def __set_expires_in(self, in_kind, in_expires_in):
+        # tokens that never expire report 0
+        self.__expires_at[in_kind] = time.time() + in_expires_in if in_expires_in else None
+        self.__expiry_changed.set()
+        
+    def __needs_refresh(self, in_kind):
+        if self.__single_flight.is_in_flight(in_kind):
+            return True
+        expires_at = self.__expires_at[in_kind]
+        return expires_at is not None and expires_at - time.time() <= self.__refresh_margin
+        
+    async def __refresh_loop(self):
+        # find out when the tokens we loaded expire
+        await self.validate_access_token()
+        if 'irc_auth_token' in self.__auth_json:
+            await self.validate_irc_access_token()
+            
+        refreshers = {"helix": self.refresh_access_token, "irc": self.refresh_irc_access_token}
+        while True:
+            try:
+                self.__expiry_changed.clear()
+                for kind, refresh in refreshers.items():
+                    if self.__expires_at[kind] is not None and self.__needs_refresh(kind):
+                        if await refresh() is None:
+                            # don't spin on a refresh that keeps failing
+                            self.__expires_at[kind] = time.time() + self.__refresh_margin + 30
+                            
+                known = [expires_at for expires_at in self.__expires_at.values() if expires_at is not None]
+                timeout = max(min(known) - self.__refresh_margin - time.time(), 0) if len(known) > 0 else None
+                try:
+                    await asyncio.wait_for(self.__expiry_changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                traceback.print_exc()
+                await asyncio.sleep(5)
+                
     def __load_auth(self):
         try:
             with open(self.__auth_file, 'r') as f:
@@ -114,8 +226,8 @@ class Auth():
             print(f"Unable to open auth file '{__auth_file}'")
             
     def __save_auth(self):
-        with open(self.__auth_file, 'w') as f:
-            json.dump(self.__auth_json, f, indent=4)
+        # copy so later changes don't race the write thread
+        self.__persistence.save(self.__auth_file, dict(self.__auth_json), lambda data: json.dumps(data, indent=4))
             
     def __assign_new_access_token(self, new_access_token, new_refresh_token):
         self.__auth_json['access_token'] = new_access_token
@@ -1,5 +1,6 @@
 import heapq
 import time
+from collections import OrderedDict
 
 class TimedCountQueue():
     def __init__(self):
@@ -20,27 +21,45 @@ class TimedCountQueue():
                 continue
             break
         return self.__count
+        
+    def get_next_expire_time(self):
+        return self.__queue[0][0] if len(self.__queue) > 0 else None
 
 class DelayQueue():
     def __init__(self):
         self.__queue = []
+        # tie breaker so entries due at the same time come out in the order they were added
+        self.__sequence = 0
         
     def add(self, data, time_until_expire):
-        heapq.heappush(self.__queue, [time.time() + time_until_expire, data])
+        self.__sequence += 1
+        heapq.heappush(self.__queue, [time.time() + time_until_expire, self.__sequence, data])
         
     def to_list(self):
-        return [[self.__queue[i][0], self.__queue[i][1].get()] for i in range(len(self.__queue))]
+        return [[self.__queue[i][0], self.__queue[i][2].get()] for i in range(len(self.__queue))]
+        
+    def get_next_time(self):
+        return self.__queue[0][0] if len(self.__queue) > 0 else None
         
     def pop(self):
         t = time.time()
         out = []
         for i in range(len(self.__queue)):
             if self.__queue[0][0] < t:
-                out.append(self.__queue[0][1])
+                out.append(self.__queue[0][2])
                 heapq.heappop(self.__queue)
                 continue
             break
         return out
+        
+    # Drops every entry whose data matches, returns how many were dropped
+    def remove_if(self, predicate):
+        kept = [entry for entry in self.__queue if not predicate(entry[2])]
+        removed = len(self.__queue) - len(kept)
+        if removed > 0:
+            heapq.heapify(kept)
+            self.__queue = kept
+        return removed
 
 class TimedCountDataQueue():
     def __init__(self):
@@ -70,3 +89,153 @@ class TimedCountDataQueue():
             
         # return the global count if we're not data matching
         return self.__count
+        
+    def get_next_expire_time(self, data_match=None):
+        if data_match:
+            times = [entry[0] for entry in self.__queue if entry[2] == data_match]
+            return min(times) if len(times) > 0 else None
+        return self.__queue[0][0] if len(self.__queue) > 0 else None
+
+class LineBuffer():
+    def __init__(self, delimiter='\r\n'):
+        self.__delimiter = delimiter
+        # trailing data from the last frame that didn't end with a delimiter
+        self.__partial = ""
+        
+    def clear(self):
+        self.__partial = ""
+        
+    def feed(self, data):
+        # no delimiter means every frame is a complete message
+        if not self.__delimiter:
+            return [data] if data else []
+            
+        if self.__partial:
+            data = self.__partial + data
+            
+        lines = data.split(self.__delimiter)
+        # the last element is either empty or an incomplete line
+        self.__partial = lines.pop()
+        return [l for l in lines if l]
+
+class TTLCache():
+    def __init__(self, in_max_size=None, in_ttl=None, in_refresh_on_access=False, in_on_evict=None):
+        # key -> [value, expire time], oldest access first
+        self.__entries = OrderedDict()
+        # most entries we keep before dropping the least recently used (None for no limit)
+        self.__max_size = in_max_size
+        # seconds an entry stays valid (None for forever)
+        self.__ttl = in_ttl
+        # if set, every get pushes the expiry back, so the ttl becomes an idle time
+        self.__refresh_on_access = in_refresh_on_access
+        # called with (key, value) when an entry is dropped for size or age, not when it's invalidated
+        self.__on_evict = in_on_evict
+        # counters
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+        self.__expirations = 0
+        
+    def __len__(self):
+        return len(self.__entries)
+        
+    def __contains__(self, key):
+        entry = self.__entries.get(key)
+        return entry is not None and (entry[1] is None or entry[1] > time.time())
+        
+    def get(self, key, default=None):
+        entry = self.__entries.get(key)
+        if entry is None:
+            self.__misses += 1
+            return default
+            
+        if entry[1] is not None and entry[1] <= time.time():
+            del self.__entries[key]
+            self.__expirations += 1
+            self.__misses += 1
+            if self.__on_evict:
+                self.__on_evict(key, entry[0])
+            return default
+            
+        self.__entries.move_to_end(key)
+        if self.__refresh_on_access and self.__ttl is not None:
+            entry[1] = time.time() + self.__ttl
+        self.__hits += 1
+        return entry[0]
+        
+    # Like get, but doesn't count as a lookup or as a use
+    def peek(self, key, default=None):
+        entry = self.__entries.get(key)
+        if entry is None or (entry[1] is not None and entry[1] <= time.time()):
+            return default
+        return entry[0]
+        
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.__ttl
+        self.__entries[key] = [value, time.time() + ttl if ttl is not None else None]
+        self.__entries.move_to_end(key)
+        
+        if self.__max_size is not None:
+            while len(self.__entries) > self.__max_size:
+                evicted_key, evicted = self.__entries.popitem(last=False)
+                self.__evictions += 1
+                if self.__on_evict:
+                    self.__on_evict(evicted_key, evicted[0])
+                    
+    # Drops expired entries from the least recently used end, stopping at the first one that's still good.
+    # With one ttl for everything that's every expired entry.
+    def prune(self):
+        now = time.time()
+        pruned = 0
+        while len(self.__entries) > 0:
+            key, entry = next(iter(self.__entries.items()))
+            if entry[1] is None or entry[1] > now:
+                break
+            del self.__entries[key]
+            self.__expirations += 1
+            pruned += 1
+            if self.__on_evict:
+                self.__on_evict(key, entry[0])
+        return pruned
+                
+    # Every (key, value), oldest use first, without counting as lookups
+    def items(self):
+        return [(key, entry[0]) for key, entry in self.__entries.items()]
+        
+    def invalidate(self, key):
+        return self.__entries.pop(key, None) is not None
+        
+    def clear(self):
+        self.__entries.clear()
+        
+    def get_stats(self):
+        lookups = self.__hits + self.__misses
+        return {
+            "size": len(self.__entries),
+            "hits": self.__hits,
+            "misses": self.__misses,
+            "hit_rate": self.__hits / lookups if lookups > 0 else 0,
+            "evictions": self.__evictions,
+            "expirations": self.__expirations
+        }
+
+class TimingStats():
+    def __init__(self):
+        self.__count = 0
+        self.__total = 0
+        self.__last = None
+        self.__max = None
+        
+    def add(self, in_seconds):
+        self.__count += 1
+        self.__total += in_seconds
+        self.__last = in_seconds
+        self.__max = in_seconds if self.__max is None else max(self.__max, in_seconds)
+        
+    def get_stats(self):
+        return {
+            "count": self.__count,
+            "last": self.__last,
+            "max": self.__max,
+            "avg": self.__total / self.__count if self.__count > 0 else None
+        }
@@ -0,0 +1,113 @@
+import asyncio
+import traceback
+from collections import deque
+
+class DispatchPool():
+    def __init__(self, in_handler, in_num_workers=8, in_max_queue_depth=256):
+        # called with each item that gets submitted
+        self.__handler = in_handler
+        # how many handlers can be running at once
+        self.__num_workers = in_num_workers
+        # how many items a single key can have waiting before submit() blocks
+        self.__max_queue_depth = in_max_queue_depth
+        # key -> items waiting to be handled, in the order they came in
+        self.__queues = dict()
+        # keys that have work waiting and aren't being handled by a worker right now
+        self.__ready_keys = asyncio.Queue()
+        # keys that are either in the ready queue or being handled by a worker
+        self.__scheduled_keys = set()
+        # lets blocked submitters know a full queue has room again
+        self.__space_available = asyncio.Condition()
+        # the running worker tasks
+        self.__workers = []
+        # counters
+        self.__pending = 0
+        self.__max_depth_seen = 0
+        self.__processed = 0
+        self.__failed = 0
+        self.__backpressure_waits = 0
+
+    def start(self):
+        loop = asyncio.get_event_loop()
+        self.__workers = [w for w in self.__workers if not w.done()]
+        if len(self.__workers) == 0:
+            # a stopped pool may have had keys in flight, so hand out everything that still has work
+            self.__ready_keys = asyncio.Queue()
+            self.__scheduled_keys = set(self.__queues.keys())
+            for key in self.__scheduled_keys:
+                self.__ready_keys.put_nowait(key)
+        while len(self.__workers) < self.__num_workers:
+            self.__workers.append(loop.create_task(self.__worker()))
+
+    def stop(self):
+        for worker in self.__workers:
+            worker.cancel()
+        self.__workers = []
+
+    def get_stats(self):
+        return {
+            "pending": self.__pending,
+            "active_keys": len(self.__queues),
+            "max_depth_seen": self.__max_depth_seen,
+            "processed": self.__processed,
+            "failed": self.__failed,
+            "backpressure_waits": self.__backpressure_waits
+        }
+
+    def get_queue_depth(self, in_key):
+        queue = self.__queues.get(in_key)
+        return len(queue) if queue else 0
+
+    async def submit(self, in_key, in_item):
+        queue = self.__queues.get(in_key)
+        if queue is None:
+            queue = self.__queues[in_key] = deque()
+
+        if len(queue) >= self.__max_queue_depth:
+            # hold up the caller (the receive loop) until a worker catches up on this key
+            self.__backpressure_waits += 1
+            async with self.__space_available:
+                await self.__space_available.wait_for(lambda: len(queue) < self.__max_queue_depth)
+            # the key may have been cleaned up while we waited
+            queue = self.__queues.setdefault(in_key, queue)
+
+        queue.append(in_item)
+        self.__pending += 1
+        if len(queue) > self.__max_depth_seen:
+            self.__max_depth_seen = len(queue)
+
+        if not in_key in self.__scheduled_keys:
+            self.__scheduled_keys.add(in_key)
+            self.__ready_keys.put_nowait(in_key)
+
+    async def __worker(self):
+        while True:
+            key = await self.__ready_keys.get()
+            queue = self.__queues.get(key)
+            if not queue:
+                self.__scheduled_keys.discard(key)
+                self.__queues.pop(key, None)
+                continue
+            item = queue.popleft()
+            self.__pending -= 1
+
+            if len(queue) == self.__max_queue_depth - 1:
+                async with self.__space_available:
+                    self.__space_available.notify_all()
+
+            try:
+                await self.__handler(item)
+                self.__processed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.__failed += 1
+                traceback.print_exc()
+
+            # only one worker handles a key at a time, so the next item for it goes to the back of the line
+            if len(queue) > 0:
+                self.__ready_keys.put_nowait(key)
+            else:
+                self.__scheduled_keys.discard(key)
+                if self.__queues.get(key) is queue:
+                    del self.__queues[key]
@@ -0,0 +1,40 @@
+import aiohttp
+import asyncio
+import ujson
+
+class HttpSession():
+    def __init__(self, in_limit=100, in_limit_per_host=30, in_dns_cache_ttl=300, in_keepalive_timeout=60, in_request_timeout=30):
+        # total connections the pool keeps open at once
+        self.__limit = in_limit
+        # connections per host (helix and id.twitch.tv each get their own)
+        self.__limit_per_host = in_limit_per_host
+        # seconds we remember dns lookups for
+        self.__dns_cache_ttl = in_dns_cache_ttl
+        # seconds an idle connection stays open for reuse
+        self.__keepalive_timeout = in_keepalive_timeout
+        # seconds before a request gives up
+        self.__request_timeout = in_request_timeout
+        # the shared session, created the first time it's needed so it lands on the running loop
+        self.__session = None
+        self.__lock = asyncio.Lock()
+
+    @property
+    def is_open(self):
+        return self.__session is not None and not self.__session.closed
+
+    async def get(self):
+        if self.is_open:
+            return self.__session
+
+        async with self.__lock:
+            if not self.is_open:
+                connector = aiohttp.TCPConnector(limit=self.__limit, limit_per_host=self.__limit_per_host,
+                                                 ttl_dns_cache=self.__dns_cache_ttl, keepalive_timeout=self.__keepalive_timeout)
+                self.__session = aiohttp.ClientSession(connector=connector, json_serialize=ujson.dumps,
+                                                       timeout=aiohttp.ClientTimeout(total=self.__request_timeout))
+        return self.__session
+
+    async def close(self):
+        if self.is_open:
+            await self.__session.close()
+        self.__session = None
@@ -0,0 +1,113 @@
+import asyncio
+import json
+import os
+import tempfile
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+class PersistenceService():
+    def __init__(self, in_debounce=0.5):
+        # saves to the same file within this many seconds become one write
+        self.__debounce = in_debounce
+        # one thread, so writes to a file land in the order they were made
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="stashio-persistence")
+        # path -> (data, serializer) for the newest save that hasn't been written yet
+        self.__pending = dict()
+        # path -> timer that writes it
+        self.__handles = dict()
+        # path -> task for the write that is running
+        self.__writes = dict()
+        self.__loop = asyncio.get_event_loop()
+        # counters
+        self.__saves = 0
+        self.__written = 0
+        self.__coalesced = 0
+        self.__failed = 0
+
+    def get_stats(self):
+        return {
+            "saves": self.__saves,
+            "written": self.__written,
+            "coalesced": self.__coalesced,
+            "failed": self.__failed,
+            "pending": len(self.__pending)
+        }
+
+    # Queues data to be written to in_path. It gets serialized on another thread, so pass a copy nobody will change.
+    def save(self, in_path, in_data, in_serializer=json.dumps):
+        self.__saves += 1
+        if in_path in self.__pending:
+            self.__coalesced += 1
+        self.__pending[in_path] = (in_data, in_serializer)
+
+        if not in_path in self.__handles:
+            self.__handles[in_path] = self.__loop.call_later(self.__debounce, self.__start_write, in_path)
+
+    # Writes everything that is waiting (or just in_path) right away
+    async def flush(self, in_path=None):
+        paths = [in_path] if in_path is not None else list(set(self.__pending) | set(self.__writes))
+        for path in paths:
+            handle = self.__handles.pop(path, None)
+            if handle:
+                handle.cancel()
+            if path in self.__pending:
+                self.__start_write(path)
+
+        tasks = [self.__writes[path] for path in paths if path in self.__writes]
+        if len(tasks) > 0:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def close(self):
+        await self.flush()
+        self.__executor.shutdown(wait=True)
+
+    def __start_write(self, in_path):
+        self.__handles.pop(in_path, None)
+        pending = self.__pending.pop(in_path, None)
+        if pending is None:
+            return
+
+        previous = self.__writes.get(in_path)
+        task = self.__loop.create_task(self.__write(in_path, pending, previous))
+        self.__writes[in_path] = task
+        task.add_done_callback(lambda t: self.__writes.pop(in_path) if self.__writes.get(in_path) is t else None)
+
+    async def __write(self, in_path, in_pending, in_previous):
+        # the older write has to finish first or it could replace the newer file
+        if in_previous is not None:
+            await asyncio.gather(in_previous, return_exceptions=True)
+
+        data, serializer = in_pending
+        try:
+            await self.__loop.run_in_executor(self.__executor, self.__write_atomic, in_path, data, serializer)
+            self.__written += 1
+        except Exception:
+            self.__failed += 1
+            print(f"Failed to save '{in_path}'")
+            traceback.print_exc()
+
+    def __write_atomic(self, in_path, in_data, in_serializer):
+        text = in_serializer(in_data)
+        directory = os.path.dirname(os.path.abspath(in_path))
+        # a crash part way through leaves the temp file behind, never a half written in_path
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(in_path) + ".", suffix=".tmp")
+        try:
+            # keep whatever permissions the file already had
+            if os.path.exists(in_path):
+                os.chmod(temp_path, os.stat(in_path).st_mode & 0o7777)
+            with os.fdopen(fd, 'w') as f:
+                f.write(text)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, in_path)
+        except:
+            os.unlink(temp_path)
+            raise
+
+        # make the rename itself survive a power loss
+        if hasattr(os, 'O_DIRECTORY'):
+            dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
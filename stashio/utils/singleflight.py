@@ -0,0 +1,33 @@
+import asyncio
+
+class SingleFlight():
+    def __init__(self):
+        # key -> task for the call that is currently running
+        self.__in_flight = dict()
+        # counters
+        self.__calls = 0
+        self.__collapsed = 0
+
+    def get_stats(self):
+        return {
+            "calls": self.__calls,
+            "collapsed": self.__collapsed,
+            "in_flight": len(self.__in_flight)
+        }
+
+    def is_in_flight(self, in_key):
+        return in_key in self.__in_flight
+
+    # Runs in_func() unless a call with the same key is already running, in which case its result (or exception) is shared
+    async def do(self, in_key, in_func):
+        self.__calls += 1
+        task = self.__in_flight.get(in_key)
+        if task is not None:
+            self.__collapsed += 1
+        else:
+            task = asyncio.get_event_loop().create_task(in_func())
+            self.__in_flight[in_key] = task
+            task.add_done_callback(lambda t: self.__in_flight.pop(in_key) if self.__in_flight.get(in_key) is t else None)
+
+        # one caller getting cancelled shouldn't cancel the call for everyone else
+        return await asyncio.shield(task)
@@ -0,0 +1,112 @@
+import asyncio
+import random
+import time
+import traceback
+
+# Seconds to wait before retry number in_attempt (0 based), doubling up to in_max with up to in_jitter of it added at random
+def backoff_delay(in_attempt, in_min=1, in_max=60, in_jitter=0.5):
+    delay = min(in_min * (2 ** in_attempt), in_max)
+    return delay + random.uniform(0, delay * in_jitter)
+
+class Supervisor():
+    def __init__(self, in_min_backoff=1, in_max_backoff=60, in_jitter=0.5, in_stable_time=30):
+        # restart delays, see backoff_delay
+        self.__min_backoff = in_min_backoff
+        self.__max_backoff = in_max_backoff
+        self.__jitter = in_jitter
+        # a child that ran at least this long before exiting starts its backoff over
+        self.__stable_time = in_stable_time
+        # name -> (async function that runs the child, async function that asks it to stop)
+        self.__children = dict()
+        # name -> task running the child's restart loop
+        self.__tasks = dict()
+        # name -> how many times it has been restarted
+        self.__restarts = dict()
+        self.__running = False
+        self.__stopping = asyncio.Event()
+        self.__loop = asyncio.get_event_loop()
+
+    @property
+    def is_running(self):
+        return self.__running
+
+    def get_stats(self):
+        return {
+            "children": len(self.__children),
+            "restarts": dict(self.__restarts)
+        }
+
+    # Registers a child, it gets started right away if we're already running
+    def add(self, in_name, in_run, in_stop=None):
+        self.__children[in_name] = (in_run, in_stop)
+        self.__restarts.setdefault(in_name, 0)
+        if self.__running:
+            self.__start_child(in_name)
+
+    def start(self):
+        self.__running = True
+        self.__stopping.clear()
+        for name in self.__children:
+            self.__start_child(name)
+
+    # Sleeps until stop() gets called
+    async def wait(self):
+        await self.__stopping.wait()
+
+    # Asks every child to stop, and cancels whatever is still running once in_deadline seconds are up
+    async def stop(self, in_deadline=10):
+        self.__running = False
+        self.__stopping.set()
+
+        stops = [stop() for _, stop in self.__children.values() if stop is not None]
+        tasks = list(self.__tasks.values())
+        self.__tasks = dict()
+
+        deadline = time.time() + in_deadline
+        if len(stops) > 0:
+            try:
+                await asyncio.wait_for(asyncio.gather(*stops, return_exceptions=True), in_deadline)
+            except asyncio.TimeoutError:
+                print("Timed out asking children to stop")
+
+        if len(tasks) > 0:
+            _, pending = await asyncio.wait(tasks, timeout=max(deadline - time.time(), 0))
+            for task in pending:
+                task.cancel()
+            if len(pending) > 0:
+                print(f"Cancelled {len(pending)} children that didn't stop in time")
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    def __start_child(self, in_name):
+        task = self.__tasks.get(in_name)
+        if task is None or task.done():
+            self.__tasks[in_name] = self.__loop.create_task(self.__child_loop(in_name))
+
+    async def __child_loop(self, in_name):
+        attempt = 0
+        while self.__running:
+            run, _ = self.__children[in_name]
+            started = time.time()
+            try:
+                await run()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                print(f"'{in_name}' crashed")
+                traceback.print_exc()
+
+            if not self.__running:
+                break
+
+            if time.time() - started >= self.__stable_time:
+                attempt = 0
+            delay = backoff_delay(attempt, self.__min_backoff, self.__max_backoff, self.__jitter)
+            attempt += 1
+            self.__restarts[in_name] += 1
+            print(f"Restarting '{in_name}' in {delay:.1f}s")
+
+            # stop() shouldn't have to wait out the backoff
+            try:
+                await asyncio.wait_for(self.__stopping.wait(), delay)
+            except asyncio.TimeoutError:
+                pass